@@ -0,0 +1,217 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import characterized_coex_sim as sim
+from hardware_config import hardware_params, HardwareConfig
+
+# Per-stage benchmarks of the sweep pipeline. Every stage is timed best-of-N
+# without tracing and then run once more under tracemalloc for its peak Python
+# memory. Results are written as JSON so runs on different commits can be
+# compared with --compare.
+#
+#   python benchmark_sweep.py --grid default --output bench.json
+#   python benchmark_sweep.py --grid large --compare bench.json
+
+# (wavelengths, fibre lengths, launch powers)
+GRIDS = {
+    'default': (5, 2, 100),
+    'medium': (20, 20, 500),
+    'large': (100, 100, 1000),
+}
+
+WORKBOOK = 'RAMAN_Charact.xlsx'
+SHEET = 'Meas_1565_HP_DP'
+
+
+def measure(name, fn, repeat=3, points=None):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(timings)
+    result = {
+        'stage': name,
+        'best_s': best,
+        'mean_s': float(np.mean(timings)),
+        'repeat': repeat,
+        'peak_memory_bytes': peak,
+        'points': points,
+        'points_per_s': points / best if points and best > 0 else None,
+    }
+    print(f"{name:<32} {best * 1e3:12.3f} ms  {peak / 2**20:10.2f} MiB" + (f"  {result['points_per_s']:14.1f} pts/s" if points else ""))
+    return result
+
+
+def skipped(name, reason):
+    print(f"{name:<32} skipped ({reason})")
+    return {'stage': name, 'skipped': reason}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(grid='default', repeat=3, netsquid_points=20):
+    n_wl, n_len, n_pow = GRIDS[grid]
+    n_points = n_wl * n_len * n_pow
+    results = []
+
+    results.append(measure('read_measurement_data', lambda: sim.read_measurement_data(WORKBOOK, SHEET), repeat=1))
+    sim.load_measurement_data(WORKBOOK, SHEET)  # make sure the cache entry exists
+    results.append(measure('load_measurement_data (cached)', lambda: sim.load_measurement_data(WORKBOOK, SHEET), repeat=repeat))
+
+    data = sim.load_measurement_data(WORKBOOK, SHEET)
+    max_power = np.max(data['P_TX'])
+    results.append(measure('calculate_rho', lambda: sim.calculate_rho(data['P_BW'], data['alpha_np'], P_in=max_power, RBW=sim.RBW), repeat=repeat))
+    rho = sim.calculate_rho(data['P_BW'], data['alpha_np'], P_in=max_power, RBW=sim.RBW)
+
+    wl_index = sim.WavelengthIndex.from_data(data)
+    wavelengths = np.linspace(1520, 1600, n_wl)
+    fiber_lengths = np.linspace(5, 100, n_len)
+    launch_powers_mW = np.linspace(0, 10, n_pow)
+    config = HardwareConfig(hardware_params)
+
+    results.append(measure('calc_raman_photon_grid', lambda: sim.calc_raman_photon_grid(launch_powers_mW, rho, wavelengths, fiber_lengths, config.detection_window, wl_index), repeat=repeat, points=n_points))
+    grid_photons = sim.calc_raman_photon_grid(launch_powers_mW, rho, wavelengths, fiber_lengths, config.detection_window, wl_index)
+
+    if n_points <= 10_000:
+        results.append(measure('calc_raman_photons (nested)', lambda: sim.calc_raman_photons(launch_powers_mW, rho, data['alpha_np'], wavelengths, fiber_lengths, config.detection_window, wl_index), repeat=repeat, points=n_points))
+
+    fibre_loss = config.fibre_loss(fiber_lengths)[np.newaxis, :, np.newaxis]
+    results.append(measure('calc_visibility_batch', lambda: sim.calc_visibility_batch(grid_photons.photons, fibre_loss, config), repeat=repeat, points=n_points))
+
+    # scalar models on a sample, reported per point
+    sample = grid_photons.photons.ravel()[:1000]
+    results.append(measure('calc_visibility (scalar)', lambda: [sim.calc_visibility(config, p, -10.0) for p in sample], repeat=repeat, points=sample.size))
+    results.append(measure('kumar_approximation (scalar)', lambda: [sim.kumar_approximation(config, p, -10.0) for p in sample], repeat=repeat, points=sample.size))
+
+    results.append(measure('simulate_grid (analytic)', lambda: sim.simulate_grid(grid_photons, config, backend="analytic"), repeat=repeat, points=n_points))
+
+    results.extend(netsquid_benchmarks(repeat=repeat, n_points=netsquid_points))
+
+    return {
+        'grid': grid,
+        'grid_shape': {'wavelengths': n_wl, 'fiber_lengths': n_len, 'launch_powers': n_pow},
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results': results,
+    }
+
+
+def netsquid_benchmarks(repeat=3, n_points=20):
+    # NetSquid stages are measured per point on a small sample
+    try:
+        import netsquid as ns
+        import import_coexisting_entanglement as ent
+    except ImportError as error:
+        names = ('characterized_network_setup', 'ns.sim_run', 'DataCollector.dataframe', 'run_coex_ent_experiment', 'CoexEntSession.run')
+        return [skipped(name, str(error)) for name in names]
+
+    results = []
+    visibilities = np.linspace(0.5, 1, n_points)
+
+    def setup():
+        ns.set_qstate_formalism(ns.QFormalism.DM)
+        ns.sim_reset()
+        for v in visibilities:
+            ent.characterized_network_setup(bell_state="phi+", depolar_prob=ent.get_dep_prob_from_v(v))
+
+    results.append(measure('characterized_network_setup', setup, repeat=repeat, points=n_points))
+
+    # sim_run and the dataframe are timed on their own, with the setup around them excluded
+    def prepared_run():
+        ns.set_qstate_formalism(ns.QFormalism.DM)
+        ns.sim_reset()
+        network, _, _ = ent.characterized_network_setup(bell_state="phi+", depolar_prob=0.1)
+        emit_prot = ent.EmitProtocol(network.get_node("Emitter"))
+        recv_prot = ent.ReceiveProtocol(network.get_node("Receiver"))
+        collector = ent.setup_datacollectors(emit_prot, recv_prot)
+        emit_prot.start()
+        recv_prot.start()
+        return collector
+
+    def timed_phase(phase):
+        total = 0.0
+        for _ in range(n_points):
+            collector = prepared_run()
+            start = time.perf_counter()
+            ns.sim_run()
+            if phase == 'dataframe':
+                start = time.perf_counter()
+                collector.dataframe
+            total += time.perf_counter() - start
+        return total
+
+    for name, phase in (('ns.sim_run', 'sim_run'), ('DataCollector.dataframe', 'dataframe')):
+        best = min(timed_phase(phase) for _ in range(repeat))
+        results.append({'stage': name, 'best_s': best, 'repeat': repeat, 'points': n_points, 'points_per_s': n_points / best if best > 0 else None})
+        print(f"{name:<32} {best * 1e3:12.3f} ms  {'':>14}  {n_points / best:14.1f} pts/s")
+
+    results.append(measure('run_coex_ent_experiment', lambda: [ent.run_coex_ent_experiment(v, verbose=False) for v in visibilities], repeat=repeat, points=n_points))
+
+    session = ent.CoexEntSession(bell_state="phi+")
+    results.append(measure('CoexEntSession.run', lambda: [session.run(v) for v in visibilities], repeat=repeat, points=n_points))
+
+    return results
+
+
+def compare(current, previous):
+    # speed-up per stage; throughput is compared where the stage has a point
+    # count, so runs on different grid sizes remain comparable
+    before = {r['stage']: r for r in previous['results'] if 'best_s' in r}
+    print(f"\ncompared with {previous.get('commit')} ({previous.get('grid')} grid):")
+    for result in current['results']:
+        old = before.get(result['stage'])
+        if old is None or 'best_s' not in result:
+            continue
+
+        if result.get('points_per_s') and old.get('points_per_s'):
+            speedup = result['points_per_s'] / old['points_per_s']
+        else:
+            speedup = old['best_s'] / result['best_s']
+        print(f"{result['stage']:<32} {speedup:8.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the coexisting Raman sweep pipeline stages")
+    parser.add_argument('--grid', choices=sorted(GRIDS), default='default')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--netsquid-points', type=int, default=20)
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="JSON file from an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(grid=args.grid, repeat=args.repeat, netsquid_points=args.netsquid_points)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,143 +1,176 @@
 #import import_coexisting_direct_transmission as direct
 
 
-import import_coexisting_entanglement as ent
+# NetSquid (import_coexisting_entanglement), pandas and matplotlib are imported
+# inside the functions that need them, so analytic-only runs start quickly
+import analytic_entanglement as analytic
+from instrumentation import stage
 #import import_coexisting_teleportation as tele
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 from math import log, e
+import argparse
+import csv
+import hashlib
+import json
+import itertools
+import os
+import shutil
+import tempfile
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from hardware_config import HardwareConfig
 
 # [1] Thomas, J. M., Yeh, F. I., Chen, J. H., Mambretti, J. J., Kohlert, S. J., Kanter, G. S., 
 # & Kumar, P. (2024). Quantum teleportation coexisting with classical communications in optical fiber. 
 # Optica, 11(12), 1700-1707.
 
 
+logger = logging.getLogger(__name__)
+
+# Intermediate quantities of the visibility models, returned on request
+VisibilityDiagnostics = namedtuple('VisibilityDiagnostics', ['raman_photons_per_det_window', 'total_transmittance_n0', 'total_transmittance_n1', 'c', 'a', 'V', 'F'])
+
+
 # Do not change: constants used for link characterization
 RBW = 0.5  # OSA Resolution Bandwidth in nm
 L=20
 KPOL=2
 
-def calc_visibility(hardware_params):
-    dark_counts_per_det_window = hardware_params['dark_counts_per_det_window']
+# Number of thermal photon-number terms needed so that the neglected tail of the
+# distribution, (mu / (1 + mu))**N, falls below tol. With max_terms set the
+# series is cut there instead, and a warning reports the probability dropped.
+def thermal_truncation(mean_photons_per_pulse, tol=1e-16, max_terms=None):
+    mu = np.max(np.asarray(mean_photons_per_pulse, dtype=float))
+    if mu <= 0:
+        return 1
 
-    # this is 0 as it is not co-propagating
-    mean_noise_photons_per_interval_d1 = hardware_params['mean_noise_photons_per_interval_d1']
+    ratio = mu / (1 + mu)
+    n_terms = max(int(np.ceil(np.log(tol) / np.log(ratio))), 1)
 
-    n_d1_db = hardware_params['detection_eff_d1'] # detector 3 detection efficiency [dB]
-    n_d1 = 10**(n_d1_db / 10) # detector 3 detection efficiency [%]
+    if max_terms is not None and n_terms > max_terms:
+        logger.warning("thermal series cut at %d terms for mean photon number %g, dropping %.3g of the probability (tol %g)",
+                       max_terms, mu, ratio**max_terms, tol)
+        return max_terms
 
-    n_d0_db = hardware_params['detection_eff_d0'] # detector 2 detection efficiency [dB]
-    n_d0 = 10**(n_d0_db / 10) # detector 2 detection efficiency [%]
+    return n_terms
 
-    n_fibre_db = hardware_params['coexisting_fibre_loss'] # # loss from Bob's source to receiver [dB]
-    n_fibre = 10**(n_fibre_db / 10) # loss from Bob's source to receiver [%]
 
-    mean_photons_per_pulse = hardware_params['mean_photons_per_pulse']
+def calc_visibility_batch(raman_photons_per_det_window, coexisting_fibre_loss, hardware_params, tol=1e-16, max_terms=None, return_diagnostics=False):
+    # Vectorized calc_visibility(): the per-point inputs and any entry of
+    # hardware_params (a dict or HardwareConfig) may be scalars or arrays,
+    # everything is broadcast together and a visibility array is returned.
+    config = HardwareConfig.from_params(hardware_params)
 
-    mean_noise_photons_per_pulse = hardware_params['mean_noise_photons_per_pulse']
+    dark_counts_per_det_window = np.asarray(config.dark_counts_per_det_window, dtype=float)
+    n_fibre = 10**(np.asarray(coexisting_fibre_loss, dtype=float) / 10) # loss from Bob's source to receiver [%]
 
-    nr_1_db = hardware_params['receiver_transmittance_d1'] # transmittance of optical elements at receiver 3 [dB]
-    nr_1 = 10**(nr_1_db / 10) # transmittance of optical elements at receiver 3 [%]
+    mean_photons_per_pulse = np.asarray(config.mean_photons_per_pulse, dtype=float)
+    mean_noise_photons_per_pulse = np.asarray(config.mean_noise_photons_per_pulse, dtype=float)
 
-    nr_0_db = hardware_params['receiver_transmittance_d0'] # transmittance of optical elements at receiver 3 [dB]
-    nr_0 = 10**(nr_0_db / 10) # transmittance of optical elements at receiver 3 [%]
+    raman_photons_per_det_window = np.asarray(raman_photons_per_det_window, dtype=float)
 
-    raman_photons_per_det_window = hardware_params['raman_photons_per_det_window']
+    total_transmittance_n1 = config.total_transmittance_n1  # total transmittance from Bob --> d1 [%]
+    total_transmittance_n0 = config.nr_0 * n_fibre * config.n_d0  # total transmittance from source --> d0 [%]
 
-    total_transmittance_n1 = nr_1 * n_d1  # total transmittance from Bob --> d3 [%]
-    total_transmittance_n0 = nr_0 * n_fibre * n_d0  # total transmittance from source --> d0 [%]
-
-    n_sprs_0 = 1 - e**(-nr_0 * n_d0 * raman_photons_per_det_window)
-    n_source_0 = 1 - e**(-total_transmittance_n0 * mean_noise_photons_per_pulse)
+    n_sprs_0 = 1 - np.exp(-config.nr_0 * config.n_d0 * raman_photons_per_det_window)
+    n_source_0 = 1 - np.exp(-total_transmittance_n0 * mean_noise_photons_per_pulse)
 
     n_sprs_1 = 0
-    n_source_1 = 1 - e**(-total_transmittance_n1 * mean_noise_photons_per_pulse)
-
-    c_01 = 0
-    a_01 = 0
+    n_source_1 = 1 - np.exp(-total_transmittance_n1 * mean_noise_photons_per_pulse)
 
-    p_0 = 0
-    p_1 = 0
-    for n in range(100):
-        p_th = (mean_photons_per_pulse**n /
-                ((1 + mean_photons_per_pulse)**(1 + n)))
+    r_0 = dark_counts_per_det_window + ((1 - dark_counts_per_det_window) * n_sprs_0) + ((1 - dark_counts_per_det_window) * (1 - n_sprs_0) * n_source_0)
+    r_1 = dark_counts_per_det_window + ((1 - dark_counts_per_det_window) * n_sprs_1) + ((1 - dark_counts_per_det_window) * (1 - n_sprs_1) * n_source_1)
 
-        r_0 = dark_counts_per_det_window + ((1 - dark_counts_per_det_window) * n_sprs_0) + ((1 - dark_counts_per_det_window) * (1 - n_sprs_0) * n_source_0)
-        r_1 = dark_counts_per_det_window + ((1 - dark_counts_per_det_window) * n_sprs_1) + ((1 - dark_counts_per_det_window) * (1 - n_sprs_1) * n_source_1)
+    # photon-number terms live on a trailing axis and are reduced in one go
+    n = np.arange(thermal_truncation(mean_photons_per_pulse, tol=tol, max_terms=max_terms))
+    expand = lambda x: np.asarray(x)[..., np.newaxis]
 
-        p_d0 = 1 - ((1 - r_0) * (1 - total_transmittance_n0)**n)
-        p_d1 = 1 - ((1 - r_1) * (1 - total_transmittance_n1)**n)
-        
-        c_01 += p_th * p_d0 * p_d1
+    # mu**n / (1 + mu)**(1 + n) written as a power of mu / (1 + mu) < 1, which
+    # stays finite however many terms tol asks for
+    mu = expand(mean_photons_per_pulse)
+    p_th = (mu / (1 + mu))**n / (1 + mu)
 
-        p_0 += p_th * p_d0   # singles probability at D0
-        p_1 += p_th * p_d1   # singles probability at D1
+    p_d0 = 1 - (expand(1 - r_0) * expand(1 - total_transmittance_n0)**n)
+    p_d1 = 1 - (expand(1 - r_1) * expand(1 - total_transmittance_n1)**n)
 
+    c_01 = np.sum(p_th * p_d0 * p_d1, axis=-1)
+    p_0 = np.sum(p_th * p_d0, axis=-1)   # singles probability at D0
+    p_1 = np.sum(p_th * p_d1, axis=-1)   # singles probability at D1
 
     a_01 = p_0 * p_1
 
-    # visibility of Detectors 2, 3
+    # visibility of Detectors 0, 1
     v_ent = (c_01 - a_01) / (c_01 + a_01)
 
-    print(f"Ram photons: {raman_photons_per_det_window}")
-    print(f"Total trans n2: {total_transmittance_n0}")
-    print(f"Total trans n3: {total_transmittance_n1}")
-    print(f"c: {c_01}")
-    print(f"a: {a_01}")
+    if return_diagnostics:
+        return VisibilityDiagnostics(raman_photons_per_det_window, total_transmittance_n0, total_transmittance_n1, c_01, a_01, v_ent, (1 + 3 * v_ent) / 4)
 
-    print(f"V: {v_ent}")
-    print("f: ", (1 + 3 * v_ent) / 4)
+    return v_ent
 
 
-    return v_ent # entanglement visibility, Alice visibility
+# Per-point inputs default to the legacy 'raman_photons_per_det_window' and
+# 'coexisting_fibre_loss' entries of a hardware_params dict
+def _per_point_inputs(hardware_params, raman_photons_per_det_window, coexisting_fibre_loss):
+    if raman_photons_per_det_window is None:
+        raman_photons_per_det_window = hardware_params['raman_photons_per_det_window']
+    if coexisting_fibre_loss is None:
+        coexisting_fibre_loss = hardware_params['coexisting_fibre_loss']
 
+    return raman_photons_per_det_window, coexisting_fibre_loss
 
 
-def kumar_approximation(hardware_params):
+def calc_visibility(hardware_params, raman_photons_per_det_window=None, coexisting_fibre_loss=None, return_diagnostics=False):
+    raman_photons_per_det_window, coexisting_fibre_loss = _per_point_inputs(hardware_params, raman_photons_per_det_window, coexisting_fibre_loss)
+
+    # diagnostics are only assembled when somebody will look at them
+    if not (return_diagnostics or logger.isEnabledFor(logging.DEBUG)):
+        return float(calc_visibility_batch(raman_photons_per_det_window, coexisting_fibre_loss, hardware_params)) # entanglement visibility, Alice visibility
+
+    diagnostics = VisibilityDiagnostics(*(float(x) for x in calc_visibility_batch(raman_photons_per_det_window, coexisting_fibre_loss, hardware_params, return_diagnostics=True)))
+    logger.debug("calc_visibility: %s", diagnostics)
+
+    return diagnostics if return_diagnostics else diagnostics.V
+
+
+
+def kumar_approximation(hardware_params, raman_photons_per_det_window=None, coexisting_fibre_loss=None, return_diagnostics=False):
     # ToDo: cite equation
     # setup assumes 2 single photon detectors: d0, d1
     # and two links, 0 and 1
     # 0 is the coexisting link, with fibre, receiver optics, and detector 0
     # 1 is the heralding arm, with receiver optics, detector 1, and no fibre
+    raman_photons_per_det_window, coexisting_fibre_loss = _per_point_inputs(hardware_params, raman_photons_per_det_window, coexisting_fibre_loss)
+    config = HardwareConfig.from_params(hardware_params)
 
-    dark_counts_per_det_window = hardware_params['dark_counts_per_det_window']
+    dark_counts_per_det_window = config.dark_counts_per_det_window
 
     # this is 0 as it is not co-propagating
-    mean_noise_photons_per_interval_d3 = hardware_params['mean_noise_photons_per_interval_d1']
-
-    n_d1_db = hardware_params['detection_eff_d1'] # detector 3 detection efficiency [dB]
-    n_d1 = 10**(n_d1_db / 10) # detector 3 detection efficiency [%]
+    mean_noise_photons_per_interval_d3 = config.mean_noise_photons_per_interval_d1
 
-    n_d0_db = hardware_params['detection_eff_d0'] # detector 2 detection efficiency [dB]
-    n_d0 = 10**(n_d0_db / 10) # detector 2 detection efficiency [%]
+    n_d1 = config.n_d1 # detector 3 detection efficiency [%]
+    n_d0 = config.n_d0 # detector 2 detection efficiency [%]
 
-    n_fibre_db = hardware_params['coexisting_fibre_loss'] # # loss from Bob's source to receiver [dB]
-    n_fibre = 10**(n_fibre_db / 10) # loss from Bob's source to receiver [%]
+    n_fibre = 10**(coexisting_fibre_loss / 10) # loss from Bob's source to receiver [%]
 
-    mean_photons_per_pulse = hardware_params['mean_photons_per_pulse']
+    mean_photons_per_pulse = config.mean_photons_per_pulse
 
-    mean_noise_photons_per_pulse = hardware_params['mean_noise_photons_per_pulse']
+    mean_noise_photons_per_pulse = config.mean_noise_photons_per_pulse
 
-    nr_1_db = hardware_params['receiver_transmittance_d1'] # transmittance of optical elements at receiver 3 [dB]
-    nr_1 = 10**(nr_1_db / 10) # transmittance of optical elements at receiver 3 [%]
+    nr_1 = config.nr_1 # transmittance of optical elements at receiver 3 [%]
+    nr_0 = config.nr_0 # transmittance of optical elements at receiver 3 [%]
 
-    nr_0_db = hardware_params['receiver_transmittance_d0'] # transmittance of optical elements at receiver 3 [dB]
-    nr_0 = 10**(nr_0_db / 10) # transmittance of optical elements at receiver 3 [%]
 
-
-    total_transmittance_n1 = nr_1 * n_d1  # total transmittance from Bob --> d3 [%]
+    total_transmittance_n1 = config.total_transmittance_n1  # total transmittance from Bob --> d3 [%]
 
     # [1] Equation S5
     r_1 = (mean_noise_photons_per_interval_d3 * n_d1 * nr_1) + (mean_noise_photons_per_pulse * total_transmittance_n1) + dark_counts_per_det_window
 
-    raman_photons_per_det_window = hardware_params['raman_photons_per_det_window']
-
     total_transmittance_n0 = nr_0 * n_fibre * n_d0  # total transmittance from source --> d0 [%]
 
     # [1] Equation S6
     r_0 = (raman_photons_per_det_window * n_d0 * nr_0) + (mean_noise_photons_per_pulse * total_transmittance_n0) + dark_counts_per_det_window
-    print("$", raman_photons_per_det_window * n_d0 * nr_0)
 
     # [1] Equation S13
     s_1 = (total_transmittance_n1 * mean_photons_per_pulse) + r_1
@@ -153,13 +186,12 @@ def kumar_approximation(hardware_params):
     # visibility of Detectors 2, 3
     v_ent = (c - a) / (c + a)
 
-    print(f"Ram photons: {raman_photons_per_det_window}")
-    print(f"Total trans n2: {total_transmittance_n0}")
-    print(f"Total trans n3: {total_transmittance_n1}")
-    print(f"c: {c}")
-    print(f"a: {a}")
+    if return_diagnostics or logger.isEnabledFor(logging.DEBUG):
+        diagnostics = VisibilityDiagnostics(raman_photons_per_det_window, total_transmittance_n0, total_transmittance_n1, c, a, v_ent, (1 + 3 * v_ent) / 4)
+        logger.debug("kumar_approximation: %s, Raman photons at d0: %s", diagnostics, raman_photons_per_det_window * n_d0 * nr_0)
 
-    print(f"V: {v_ent}")
+        if return_diagnostics:
+            return diagnostics
 
 
     return v_ent # entanglement visibility, Alice visibility
@@ -170,6 +202,8 @@ def kumar_approximation(hardware_params):
 get_photon_energy = lambda wl_nm: (1240 / wl_nm) * 1.6e-19
 
 def read_measurement_data(filename, sheet_name):
+    import pandas as pd
+
     data_table = pd.read_excel(filename, sheet_name=sheet_name)
     data = data_table.to_numpy()
     return {
@@ -181,6 +215,47 @@ def read_measurement_data(filename, sheet_name):
         'alpha_np': (data[:, 5] / 10) * (np.log10(np.exp(1)))  
     }
 
+MEASUREMENT_KEYS = ('wavelengths', 'P_TX', 'P_CT', 'P_BW', 'P_RX', 'alpha_np')
+
+# Same dict as read_measurement_data(), but the converted arrays are stored once
+# per (workbook, sheet) as .npy files and memory-mapped on later loads, so pool
+# workers share pages instead of each re-parsing the workbook. The cache entry
+# is keyed on the workbook path, size and mtime and the sheet name.
+def load_measurement_data(filename, sheet_name, cache_dir=None, mmap_mode='r'):
+    stat = os.stat(filename)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), '.measurement_cache')
+
+    key = hashlib.sha1(repr((os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, sheet_name)).encode()).hexdigest()
+    entry_dir = os.path.join(cache_dir, key)
+
+    if not os.path.isdir(entry_dir):
+        data = read_measurement_data(filename, sheet_name)
+
+        arrays = {name: np.ascontiguousarray(data[name], dtype=float) for name in MEASUREMENT_KEYS}
+
+        # write into a scratch directory first so readers never see a partial entry
+        scratch_dir = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            scratch_dir = tempfile.mkdtemp(dir=cache_dir)
+            for name, values in arrays.items():
+                np.save(os.path.join(scratch_dir, f"{name}.npy"), values)
+        except OSError as err:
+            # read-only or full cache location: use the workbook data uncached
+            logger.warning("Cannot write the measurement cache in %s (%s); using uncached data", cache_dir, err)
+            if scratch_dir is not None:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+            return arrays
+
+        try:
+            os.rename(scratch_dir, entry_dir)
+        except OSError:
+            # another process published the same entry first
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return {name: np.load(os.path.join(entry_dir, f"{name}.npy"), mmap_mode=mmap_mode) for name in MEASUREMENT_KEYS}
+
 def calculate_rho(P_BW, alpha_np, P_in, RBW):
     k_Pin = P_in * np.exp(-alpha_np * L)
     k_sinh = np.sinh(alpha_np * L) / alpha_np
@@ -190,72 +265,658 @@ NP_PER_DB = np.log(10) / 10          # ≈ 0.2302585 Np per dB
 DB_PER_NP = 10 / np.log(10)          # ≈ 4.3429448 dB per Np
 DB_PER_KM = 0.2
 
-def calc_raman_photons(P_launch, rho, alpha_np, wavelengths, fiber_lengths, detection_window):
-    ram_photons_per_det_window = {wl: {L: [] for L in fiber_lengths} for wl in wavelengths}
+class WavelengthIndex:
+    # Sorted view of the measured wavelength column, built once per dataset.
+    # lookup() maps wavelengths to rows of the original table in O(log n);
+    # interp() linearly interpolates any per-row quantity (rho, alpha_np, ...)
+    # at arbitrary wavelength arrays inside the measured band.
+    def __init__(self, measured_wavelengths, atol=1e-6):
+        # np.unique keeps the first row of any repeated wavelength
+        self.wavelengths, self.rows = np.unique(np.asarray(measured_wavelengths, dtype=float), return_index=True)
+        self.atol = atol
 
-    for p_mW in P_launch:
-        p_W = p_mW * 1e-3  # convert mW -> W once
+    @classmethod
+    def from_data(cls, data):
+        return cls(data['wavelengths'])
 
-        for L_km in fiber_lengths:
-            for wl in wavelengths:
-                idx = np.where(np.isclose(data['wavelengths'], wl))[0][0]
+    def __len__(self):
+        return len(self.wavelengths)
 
-                #alpha = alpha_np[idx]  # Np/km (power attenuation)
-                alpha = 0.2 * log(10) / 10 # 1 / km
-                
-                L_eff = (1 - np.exp(-alpha * L_km)) / alpha
+    def _check_in_band(self, wl):
+        if np.any((wl < self.wavelengths[0]) | (wl > self.wavelengths[-1])):
+            raise ValueError(f"wavelengths outside the measured band [{self.wavelengths[0]}, {self.wavelengths[-1]}] nm")
+
+    def lookup(self, wl):
+        wl = np.asarray(wl, dtype=float)
+        self._check_in_band(wl)
+
+        # nearest of the two neighbouring measured wavelengths
+        right = np.clip(np.searchsorted(self.wavelengths, wl), 1, len(self.wavelengths) - 1)
+        left = right - 1
+        nearest = np.where(np.abs(self.wavelengths[right] - wl) < np.abs(wl - self.wavelengths[left]), right, left)
+
+        if np.any(np.abs(self.wavelengths[nearest] - wl) > self.atol):
+            raise KeyError(f"wavelengths not measured: {wl[np.abs(self.wavelengths[nearest] - wl) > self.atol]}")
+
+        return self.rows[nearest]
+
+    def interp(self, values, wl, fill_value=None):
+        # outside the measured band: ValueError, or fill_value when one is given
+        wl = np.asarray(wl, dtype=float)
+        if fill_value is None:
+            self._check_in_band(wl)
+
+        return np.interp(wl, self.wavelengths, np.asarray(values, dtype=float)[self.rows], left=fill_value, right=fill_value)
 
 
-                # Receiver Raman power (W)
-                power_fw = p_W * KPOL * rho[idx] * RBW * L_eff
+class RamanPhotonGrid(namedtuple('RamanPhotonGrid', ['photons', 'launch_powers_mW', 'fiber_lengths', 'wavelengths'])):
+    # Raman photons per detection window on a dense (power x length x wavelength)
+    # grid, together with the coordinate vector of each axis
+    __slots__ = ()
 
-                energy_photon = get_photon_energy(wl)  # J
-                photon_count = (power_fw / energy_photon) * detection_window
+    def at(self, wl, L):
+        # photons along the launch-power axis for one (wavelength, length) pair
+        return self.photons[:, list(self.fiber_lengths).index(L), list(self.wavelengths).index(wl)]
 
-                ram_photons_per_det_window[wl][L_km].append(photon_count)
+    def to_nested(self):
+        # legacy {wl: {L: [photons per launch power]}} layout
+        return {wl: {L: self.at(wl, L).tolist() for L in self.fiber_lengths} for wl in self.wavelengths}
 
-    return ram_photons_per_det_window
 
+# Elementwise Raman photons per detection window; all array arguments broadcast
+def raman_photon_count(P_launch_mW, fiber_length_km, wavelength_nm, rho_wl, detection_window):
+    p_W = P_launch_mW * 1e-3  # convert mW -> W
+
+    alpha = DB_PER_KM * log(10) / 10 # 1 / km
+    L_eff = (1 - np.exp(-alpha * fiber_length_km)) / alpha
+
+    # Receiver Raman power (W)
+    power_fw = p_W * KPOL * rho_wl * RBW * L_eff
+
+    energy_photon = get_photon_energy(wavelength_nm)  # J
+    return (power_fw / energy_photon) * detection_window
+
+
+def calc_raman_photon_grid(P_launch, rho, wavelengths, fiber_lengths, detection_window, wl_index):
+    P_launch = np.asarray(P_launch, dtype=float)
+    fiber_lengths = np.asarray(fiber_lengths, dtype=float)
+    wavelengths = np.asarray(wavelengths, dtype=float)
+
+    if not isinstance(wl_index, WavelengthIndex):
+        wl_index = WavelengthIndex(wl_index)
+
+    photon_count = raman_photon_count(
+        P_launch[:, np.newaxis, np.newaxis],
+        fiber_lengths[np.newaxis, :, np.newaxis],
+        wavelengths[np.newaxis, np.newaxis, :],
+        wl_index.interp(rho, wavelengths)[np.newaxis, np.newaxis, :],
+        detection_window
+    )
+
+    return RamanPhotonGrid(photon_count, P_launch, fiber_lengths, wavelengths)
 
 
+def calc_raman_photons(P_launch, rho, alpha_np, wavelengths, fiber_lengths, detection_window, wl_index):
+    # nested-dict view of calc_raman_photon_grid(); alpha_np is kept for
+    # signature compatibility, the fixed DB_PER_KM attenuation is used
+    grid = calc_raman_photon_grid(P_launch, rho, wavelengths, fiber_lengths, detection_window, wl_index)
+    return {wl: {L: grid.photons[:, j, i].tolist() for j, L in enumerate(fiber_lengths)} for i, wl in enumerate(wavelengths)}
 
-def simulate(ram_photons_per_det_window, hardware_params, fiber_lengths, wavelengths, alpha_np, wavelengths_np):
+
+
+
+def simulate(ram_photons_per_det_window, hardware_params, fiber_lengths, wavelengths, alpha_np, wavelengths_np, backend="netsquid", cross_check=0, cache=None,
+             precision=1e-3, max_shots=1_000_000, base_seed=1):
+    # precision and max_shots set the stopping rule of the montecarlo backend;
+    # NetSquid points are seeded with point_seed(i, j, k, base_seed) like
+    # simulate_parallel()
     fidelities = {wl: {L: [] for L in fiber_lengths} for wl in wavelengths}
     ns_fidelities = {wl: {L: [] for L in fiber_lengths} for wl in wavelengths}
     p_mix = {wl: {L: [] for L in fiber_lengths} for wl in wavelengths}
 
+    if isinstance(ram_photons_per_det_window, RamanPhotonGrid):
+        ram_photons_per_det_window = ram_photons_per_det_window.to_nested()
+
+    # static parameters are converted once, per-point values are passed alongside
+    config = HardwareConfig.from_params(hardware_params)
+
+    # network is built once, on the first uncached point, and only its depolarization is changed per point
+    session = None
 
-    for wl in wavelengths:
-        for l in fiber_lengths:
-            for p in ram_photons_per_det_window[wl][l]:
-                idx = np.where(np.isclose(wavelengths_np, wl))[0][0]
+    # Monte Carlo estimates depend on the stopping rule, so it is part of the cache key
+    cache_options = {'precision': precision, 'max_shots': max_shots} if backend == "montecarlo" else None
 
+    if backend != "analytic" or cross_check:
+        import import_coexisting_entanglement as ent
+
+    for i, wl in enumerate(wavelengths):
+        for j, l in enumerate(fiber_lengths):
+            if backend == "analytic":
+                # whole launch-power axis in one batch, no NetSquid event loop
+                photons = np.asarray(ram_photons_per_det_window[wl][l], dtype=float)
+                fibre_loss = config.fibre_loss(l)
+                with stage("simulate.visibility"):
+                    visibility = calc_visibility_batch(photons, fibre_loss, config)
+                with stage("simulate.fidelity"):
+                    fidelity, _ = analytic.run_coex_ent_analytic(visibility, bell_state="phi+")
+
+                if cross_check:
+                    ent.cross_check_backends(visibility, bell_state="phi+", n_samples=cross_check)
+
+                fidelities[wl][l].extend(((1 + 3*visibility) / 4).tolist())
+                ns_fidelities[wl][l].extend(fidelity.tolist())
+                continue
+
+            for k, p in enumerate(ram_photons_per_det_window[wl][l]):
                 # CONFIGURABLE: since only distributing entanglement, Alice's channel is not utilized so no Raman photons are generated
-                hardware_params['raman_photons_per_det_window'] = p
-                hardware_params['coexisting_fibre_loss'] = hardware_params['fibre_attenuation'] * l
-                print(f"Link length: {l} km. , Fibre loss: {hardware_params['coexisting_fibre_loss']} dB")
+                fibre_loss = config.fibre_loss(l)
+                logger.debug("Link length: %s km. , Fibre loss: %s dB", l, fibre_loss)
+
+                seed = point_seed(i, j, k, base_seed)
+
+                if cache is not None:
+                    with stage("simulate.cache_lookup"):
+                        key = cache.key(config, p, fibre_loss, bell_state="phi+", random_seed=seed, backend=backend, options=cache_options)
+                        cached = cache.get(key)
+                    if cached is not None:
+                        visibility, fidelity = cached
+                        fidelities[wl][l].append((1 + 3*visibility) / 4)
+                        ns_fidelities[wl][l].append(fidelity)
+                        continue
 
                 # CONFIGURABLE: if visibility already know, you may just use that
                 # ReadME: if your hardware setup does not match the configuration file, the calc_visibility() function will need to be modified to model your system
                 
-                visibility = calc_visibility(hardware_params)
-
-                fidelity, _, _, depolar_prob = ent.run_coex_ent_experiment(
-                    bell_state="phi+",
-                    noisy_visibility=visibility,
-                    verbose=False
-                )
+                with stage("simulate.visibility"):
+                    visibility = calc_visibility(config, raman_photons_per_det_window=p, coexisting_fibre_loss=fibre_loss)
+
+                if session is None:
+                    with stage("simulate.session_setup"):
+                        session = ent.session_for_backend(backend, bell_state="phi+")
+
+                with stage("simulate.fidelity"):
+                    if backend == "netsquid":
+                        fidelity, _, _, depolar_prob = session.run(noisy_visibility=visibility, random_seed=seed)
+                    else:
+                        fidelity, _, _, depolar_prob = ent.run_coex_ent_experiment(
+                            bell_state="phi+",
+                            noisy_visibility=visibility,
+                            random_seed=seed,
+                            verbose=False,
+                            backend=backend,
+                            session=session,
+                            precision=precision,
+                            max_shots=max_shots
+                        )
+
+                if cache is not None:
+                    cache.put(key, (visibility, fidelity))
 
                 fidelities[wl][l].append((1 + 3*visibility) / 4)
                 ns_fidelities[wl][l].append(fidelity)
+
+    if cache is not None:
+        cache.flush()
     
     return fidelities, ns_fidelities
 
 
-if __name__ == "__main__":
+def simulate_grid(grid, hardware_params, backend="analytic", bell_state="phi+"):
+    # Evaluates a RamanPhotonGrid directly and returns the depolarized-model and
+    # simulated fidelities as arrays shaped like grid.photons
+    config = HardwareConfig.from_params(hardware_params)
+
+    fibre_loss = config.fibre_loss(grid.fiber_lengths)[np.newaxis, :, np.newaxis]
+    visibility = calc_visibility_batch(grid.photons, fibre_loss, config)
+
+    if backend == "analytic":
+        ns_fidelities, _ = analytic.run_coex_ent_analytic(visibility, bell_state=bell_state)
+    else:
+        import import_coexisting_entanglement as ent
+
+        # every grid point is one emission of a single simulation run
+        session = ent.CoexEntSession(bell_state=bell_state)
+        ns_fidelities, _, _ = session.run_pairs(visibility.ravel())
+        ns_fidelities = ns_fidelities.reshape(visibility.shape)
+
+    return (1 + 3*visibility) / 4, ns_fidelities
+
+
+RouteEvaluation = namedtuple('RouteEvaluation', ['fidelity', 'visibility', 'depolar_prob', 'raman_photons', 'fibre_loss', 'segment_raman_photons'])
+
+def evaluate_route(segments, hardware_params, rho, wl_index, bell_state="phi+"):
+    # segments: sequence of (length_km, launch_power_mW, wavelength_nm), one per
+    # span from the source towards the receiver, or an array of shape
+    # (..., n_segments, 3) holding several routes. Every span carries its own
+    # classical launch power. The Raman photons it adds at its end reach the
+    # receiver attenuated by the spans after it; those contributions are summed
+    # and, with the total fibre loss, give one visibility for the whole route,
+    # so the source and the detectors are only counted once.
+    config = HardwareConfig.from_params(hardware_params)
+    segments = np.asarray(segments, dtype=float)
+    lengths, powers, wls = segments[..., 0], segments[..., 1], segments[..., 2]
+
+    if not isinstance(wl_index, WavelengthIndex):
+        wl_index = WavelengthIndex(wl_index)
+
+    # fibre after each span, up to the receiver
+    length_after = np.cumsum(lengths[..., ::-1], axis=-1)[..., ::-1] - lengths
+
+    photons = raman_photon_count(powers, lengths, wls, wl_index.interp(rho, wls), config.detection_window)
+    segment_photons = photons * 10**(config.fibre_loss(length_after) / 10)
+
+    raman_photons = np.sum(segment_photons, axis=-1)
+    fibre_loss = config.fibre_loss(np.sum(lengths, axis=-1))
+    visibility = calc_visibility_batch(raman_photons, fibre_loss, config)
+
+    # the route is a single depolarizing link; for a NetSquid run of it pass
+    # the visibility to import_coexisting_entanglement.cross_check_backends()
+    fidelity, depolar_prob = analytic.run_coex_ent_analytic(visibility, bell_state=bell_state)
+
+    return RouteEvaluation(fidelity, visibility, depolar_prob, raman_photons, fibre_loss, segment_photons)
+
+
+def cross_check_route(length_km, n_segments, wavelength_nm, launch_powers_mW, hardware_params, rho, wl_index, atol=1e-12):
+    # A one-span route has to match the single coexisting link, and cutting the
+    # fibre into n_segments equal spans launched at the same power must not
+    # change the fidelity: the L_eff Raman of the spans, each attenuated by the
+    # fibre after it, adds up to the L_eff Raman of the whole length.
+    config = HardwareConfig.from_params(hardware_params)
+    if not isinstance(wl_index, WavelengthIndex):
+        wl_index = WavelengthIndex(wl_index)
+
+    launch_powers_mW = np.asarray(launch_powers_mW, dtype=float)[:, np.newaxis]
+    span = lambda length: np.stack(np.broadcast_arrays(length, launch_powers_mW, wavelength_nm), axis=-1)
+
+    single = evaluate_route(span(np.array([length_km], dtype=float)), config, rho, wl_index)
+    split = evaluate_route(span(np.full(n_segments, length_km / n_segments)), config, rho, wl_index)
+
+    photons = raman_photon_count(launch_powers_mW[:, 0], length_km, wavelength_nm, wl_index.interp(rho, wavelength_nm), config.detection_window)
+    link = calc_visibility_batch(photons, config.fibre_loss(length_km), config)
+
+    if not np.allclose(single.visibility, link, rtol=0, atol=atol):
+        raise AssertionError(f"one-span route disagrees with the single link: {single.visibility} != {link}")
+    if not np.allclose(split.fidelity, single.fidelity, rtol=0, atol=atol):
+        raise AssertionError(f"{n_segments}-span route disagrees with one {length_km} km span: {split.fidelity} != {single.fidelity}")
+
+    return single.fidelity, split.fidelity
+
+
+# Largest x in [lo, hi] with decreasing(x) >= target, found by bisection on
+# every element at once. nan where even lo misses the target, hi where hi meets it.
+def _bisect_decreasing(decreasing, lo, hi, target, xtol=1e-9, max_iter=200):
+    lo, hi, target = np.broadcast_arrays(np.asarray(lo, dtype=float), np.asarray(hi, dtype=float), np.asarray(target, dtype=float))
+    lo, hi = lo.copy(), hi.copy()
+
+    feasible = decreasing(lo) >= target
+    saturated = decreasing(hi) >= target
+
+    for _ in range(max_iter):
+        if np.all(hi - lo <= xtol):
+            break
+        mid = (lo + hi) / 2
+        ok = decreasing(mid) >= target
+        lo = np.where(ok, mid, lo)
+        hi = np.where(ok, hi, mid)
+
+    return np.where(saturated, hi, np.where(feasible, lo, np.nan))
+
+
+def _target_visibility(target, target_kind):
+    if target_kind == "visibility":
+        return np.asarray(target, dtype=float)
+    if target_kind == "fidelity":
+        # inverse of F = (1 + 3V) / 4
+        return (4 * np.asarray(target, dtype=float) - 1) / 3
+    raise ValueError(f"unknown target_kind {target_kind!r}. Must be 'fidelity' or 'visibility'")
+
+
+def max_launch_power(target, wavelengths, fiber_lengths, hardware_params, rho, wl_index, target_kind="fidelity", p_max_mW=1000.0, xtol=1e-9):
+    # Maximum classical launch power [mW] per (fibre length, wavelength) for
+    # which the link still meets target; returns an array shaped
+    # (len(fiber_lengths), len(wavelengths)).
+    config = HardwareConfig.from_params(hardware_params)
+    if not isinstance(wl_index, WavelengthIndex):
+        wl_index = WavelengthIndex(wl_index)
+
+    wavelengths = np.asarray(wavelengths, dtype=float)[np.newaxis, :]
+    fiber_lengths = np.asarray(fiber_lengths, dtype=float)[:, np.newaxis]
+    rho_wl = wl_index.interp(rho, wavelengths)
+    fibre_loss = config.fibre_loss(fiber_lengths)
+
+    def visibility(p_mW):
+        photons = raman_photon_count(p_mW, fiber_lengths, wavelengths, rho_wl, config.detection_window)
+        return calc_visibility_batch(photons, fibre_loss, config)
+
+    lo = np.zeros(np.broadcast_shapes(fiber_lengths.shape, wavelengths.shape))
+    return _bisect_decreasing(visibility, lo, p_max_mW, _target_visibility(target, target_kind), xtol=xtol)
+
+
+def max_fibre_length(target, wavelengths, launch_powers_mW, hardware_params, rho, wl_index, target_kind="fidelity", L_max_km=500.0, xtol=1e-9):
+    # Maximum fibre length [km] per (launch power, wavelength) for which the
+    # link still meets target; returns an array shaped
+    # (len(launch_powers_mW), len(wavelengths)).
+    config = HardwareConfig.from_params(hardware_params)
+    if not isinstance(wl_index, WavelengthIndex):
+        wl_index = WavelengthIndex(wl_index)
+
+    wavelengths = np.asarray(wavelengths, dtype=float)[np.newaxis, :]
+    launch_powers_mW = np.asarray(launch_powers_mW, dtype=float)[:, np.newaxis]
+    rho_wl = wl_index.interp(rho, wavelengths)
+
+    def visibility(L_km):
+        photons = raman_photon_count(launch_powers_mW, L_km, wavelengths, rho_wl, config.detection_window)
+        return calc_visibility_batch(photons, config.fibre_loss(L_km), config)
+
+    lo = np.zeros(np.broadcast_shapes(launch_powers_mW.shape, wavelengths.shape))
+    return _bisect_decreasing(visibility, lo, L_max_km, _target_visibility(target, target_kind), xtol=xtol)
+
+
+PUMP_WAVELENGTH = 1565.0 # classical pump wavelength of the Meas_1565 measurements [nm]
+
+ITU_ANCHOR_THZ = 193.1 # ITU-T G.694.1 DWDM grid anchor frequency
+C_NM_THZ = 299792.458 # speed of light [nm * THz]
+
+def dwdm_grid(wl_index, spacing_ghz=100.0):
+    # ITU DWDM channel wavelengths [nm] inside the measured band, ascending
+    if not isinstance(wl_index, WavelengthIndex):
+        wl_index = WavelengthIndex(wl_index)
+
+    spacing_thz = spacing_ghz * 1e-3
+    f_low, f_high = C_NM_THZ / wl_index.wavelengths[-1], C_NM_THZ / wl_index.wavelengths[0]
+    n = np.arange(np.ceil((f_low - ITU_ANCHOR_THZ) / spacing_thz), np.floor((f_high - ITU_ANCHOR_THZ) / spacing_thz) + 1)
+
+    return np.sort(C_NM_THZ / (ITU_ANCHOR_THZ + n * spacing_thz))
+
+
+ChannelAllocation = namedtuple('ChannelAllocation', ['classical_wavelengths', 'quantum_wavelengths', 'fidelities'])
+
+def _allocation_fidelity(classical_wavelengths, classical_powers_mW, quantum_wavelengths, fiber_length, config, rho, wl_index, guard_band_nm, pump_wavelength):
+    # classical_wavelengths: (n_assignments, n_classical); returns fidelities of
+    # shape (n_assignments, n_quantum), nan where a quantum channel falls inside
+    # a guard band or outside the measured spectrum.
+    #
+    # rho was measured with the pump at pump_wavelength; a classical channel at
+    # another wavelength is approximated by shifting the measured spectrum by
+    # the same detuning.
+    classical_wavelengths = np.asarray(classical_wavelengths, dtype=float)[:, np.newaxis, :]
+    classical_powers_mW = np.asarray(classical_powers_mW, dtype=float)[np.newaxis, np.newaxis, :]
+    quantum = np.asarray(quantum_wavelengths, dtype=float)[np.newaxis, :, np.newaxis]
+
+    rho_shifted = wl_index.interp(rho, quantum - classical_wavelengths + pump_wavelength, fill_value=np.nan)
+    photons = np.sum(raman_photon_count(classical_powers_mW, fiber_length, quantum, rho_shifted, config.detection_window), axis=-1)
+
+    visibility = calc_visibility_batch(photons, config.fibre_loss(fiber_length), config)
+    fidelity = (1 + 3*visibility) / 4
+
+    in_guard_band = np.any(np.abs(quantum - classical_wavelengths) < guard_band_nm, axis=-1)
+    return np.where(in_guard_band, np.nan, fidelity)
+
+
+def _best(fidelity, top):
+    # flat indices of the top finite fidelities, best first, ties in input order
+    order = np.argsort(np.where(np.isnan(fidelity), -np.inf, -fidelity), kind='stable')
+    return order[~np.isnan(fidelity[order])][:top]
+
+
+def rank_quantum_channels(classical_channels, fiber_length, hardware_params, rho, wl_index, candidates=None, guard_band_nm=1.0, pump_wavelength=PUMP_WAVELENGTH, top=None):
+    # Ranks candidate quantum-channel wavelengths (default: the 100 GHz DWDM
+    # grid, dwdm_grid()) by fidelity for fixed classical_channels, a sequence
+    # of (wavelength_nm, launch_power_mW). Best channel first.
+    config = HardwareConfig.from_params(hardware_params)
+    if not isinstance(wl_index, WavelengthIndex):
+        wl_index = WavelengthIndex(wl_index)
+
+    candidates = dwdm_grid(wl_index) if candidates is None else np.asarray(candidates, dtype=float)
+    classical = np.asarray(classical_channels, dtype=float).reshape(-1, 2)
+
+    fidelity = _allocation_fidelity(classical[np.newaxis, :, 0], classical[:, 1], candidates, fiber_length, config, rho, wl_index, guard_band_nm, pump_wavelength)[0]
+    order = _best(fidelity, top)
+
+    return ChannelAllocation(np.broadcast_to(classical[:, 0], (len(order), len(classical))), candidates[order], fidelity[order])
+
+
+def _power_orders(powers):
+    # Every distinct assignment of the channel powers to ordered slot positions,
+    # as arrays order[m] = channel placed at position m. Channels of equal power
+    # are interchangeable, so equal powers give a single order.
+    groups = [np.flatnonzero(powers == value) for value in np.unique(powers)]
+
+    def fill(order, free, g):
+        if g == len(groups):
+            yield order.copy()
+            return
+        for positions in itertools.combinations(free, len(groups[g])):
+            order[list(positions)] = groups[g]
+            yield from fill(order, [p for p in free if p not in positions], g + 1)
+
+    return list(fill(np.empty(len(powers), dtype=int), list(range(len(powers))), 0))
+
+
+def optimize_channel_allocation(classical_powers_mW, classical_slots, fiber_length, hardware_params, rho, wl_index, candidates=None, guard_band_nm=1.0,
+                                pump_wavelength=PUMP_WAVELENGTH, top=10, chunk_size=4096):
+    # Searches every distinct placement of the classical channels onto
+    # classical_slots together with every candidate quantum wavelength (default:
+    # dwdm_grid()). Slot sets are enumerated as combinations and the powers
+    # assigned in their distinct orders; placements are evaluated in vectorized
+    # batches of about chunk_size while only the running top is kept. Returns
+    # the top (classical placement, quantum wavelength) pairs by fidelity.
+    config = HardwareConfig.from_params(hardware_params)
+    if not isinstance(wl_index, WavelengthIndex):
+        wl_index = WavelengthIndex(wl_index)
+
+    candidates = dwdm_grid(wl_index) if candidates is None else np.asarray(candidates, dtype=float)
+    classical_powers_mW = np.asarray(classical_powers_mW, dtype=float)
+    classical_slots = np.asarray(classical_slots, dtype=float)
+    n_classical = len(classical_powers_mW)
+
+    # Raman photons of every (channel power, slot, candidate) and the guard
+    # bands, computed once; a batch only gathers and sums them (see
+    # _allocation_fidelity() for the shifted-spectrum approximation)
+    powers, power_of_channel = np.unique(classical_powers_mW, return_inverse=True)
+    rho_shifted = wl_index.interp(rho, candidates[np.newaxis, :] - classical_slots[:, np.newaxis] + pump_wavelength, fill_value=np.nan)
+    slot_photons = raman_photon_count(powers[:, np.newaxis, np.newaxis], fiber_length, candidates[np.newaxis, np.newaxis, :], rho_shifted[np.newaxis], config.detection_window)
+    slot_guard_band = np.abs(candidates[np.newaxis, :] - classical_slots[:, np.newaxis]) < guard_band_nm
+    fibre_loss = config.fibre_loss(fiber_length)
+
+    # slots[:, c] is the slot index of channel c: column m of a slot
+    # combination goes to channel order[m]
+    inverse = [np.argsort(order) for order in _power_orders(classical_powers_mW)]
+    combinations = itertools.combinations(range(len(classical_slots)), n_classical)
+    block_size = max(1, chunk_size // len(inverse))
+
+    best_slots = np.empty((0, n_classical), dtype=int)
+    best_quantum = np.empty(0, dtype=int)
+    best_fidelities = np.empty(0)
+
+    while True:
+        block = np.array(list(itertools.islice(combinations, block_size)), dtype=int).reshape(-1, n_classical)
+        if block.size == 0:
+            break
+
+        slots = np.concatenate([block[:, inv] for inv in inverse])
+        photons = sum(slot_photons[power_of_channel[c], slots[:, c]] for c in range(n_classical))
+        in_guard_band = np.any(slot_guard_band[slots], axis=1)
+
+        visibility = calc_visibility_batch(photons, fibre_loss, config)
+        fidelity = np.where(in_guard_band, np.nan, (1 + 3*visibility) / 4)
+
+        order = _best(fidelity.ravel(), top)
+        placement, quantum = np.unravel_index(order, fidelity.shape)
+
+        # earlier batches first, so ties keep enumeration order
+        best_slots = np.concatenate([best_slots, slots[placement]])
+        best_quantum = np.concatenate([best_quantum, quantum])
+        best_fidelities = np.concatenate([best_fidelities, fidelity.ravel()[order]])
+
+        keep = _best(best_fidelities, top)
+        best_slots, best_quantum, best_fidelities = best_slots[keep], best_quantum[keep], best_fidelities[keep]
+
+    return ChannelAllocation(classical_slots[best_slots], candidates[best_quantum], best_fidelities)
+
+
+# fidelity backends, named as in import_coexisting_entanglement.run_coex_ent_experiment()
+BACKENDS = ("netsquid", "analytic", "montecarlo")
+
+# Deterministic NetSquid seed for grid point (i, j, k), independent of how the
+# grid is split across workers
+def point_seed(i, j, k, base_seed=1):
+    return int(np.random.SeedSequence(base_seed, spawn_key=(i, j, k)).generate_state(1)[0])
+
+
+# per-process network sessions, built lazily the first time a worker needs one
+_worker_sessions = {}
+
+def _simulate_chunk(points, hardware_params, backend, bell_state, precision, max_shots):
+    # points: list of (i, j, k, fibre_length, raman_photons, seed)
+    photons = np.array([point[4] for point in points], dtype=float)
+    fibre_loss = hardware_params.fibre_loss(np.array([point[3] for point in points], dtype=float))
+    visibility = calc_visibility_batch(photons, fibre_loss, hardware_params)
+
+    if backend == "analytic":
+        fidelity, _ = analytic.run_coex_ent_analytic(visibility, bell_state=bell_state)
+    else:
+        import import_coexisting_entanglement as ent
+
+        if (backend, bell_state) not in _worker_sessions:
+            _worker_sessions[backend, bell_state] = ent.session_for_backend(backend, bell_state=bell_state)
+        session = _worker_sessions[backend, bell_state]
+
+        if backend == "montecarlo":
+            fidelity = [ent.run_coex_ent_experiment(v, random_seed=point[5], bell_state=bell_state, verbose=False, backend=backend,
+                                                    session=session, precision=precision, max_shots=max_shots)[0] for v, point in zip(visibility, points)]
+        else:
+            fidelity = [session.run(noisy_visibility=v, random_seed=point[5])[0] for v, point in zip(visibility, points)]
+
+    return [(point[0], point[1], point[2], (1 + 3*v) / 4, float(f)) for point, v, f in zip(points, visibility, fidelity)]
+
+
+def simulate_parallel(ram_photons_per_det_window, hardware_params, fiber_lengths, wavelengths, backend="netsquid", max_workers=None, chunk_size=64, base_seed=1, bell_state="phi+",
+                      precision=1e-3, max_shots=1_000_000):
+    # Same result layout as simulate(). The (wl, L, P) grid is cut into chunks
+    # of a fixed size, so results do not depend on max_workers.
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend!r}. Must be one of: {BACKENDS}")
+
+    if isinstance(ram_photons_per_det_window, RamanPhotonGrid):
+        ram_photons_per_det_window = ram_photons_per_det_window.to_nested()
+
+    points = []
+    for i, wl in enumerate(wavelengths):
+        for j, l in enumerate(fiber_lengths):
+            for k, p in enumerate(ram_photons_per_det_window[wl][l]):
+                points.append((i, j, k, l, p, point_seed(i, j, k, base_seed)))
+
+    chunks = [points[n:n + chunk_size] for n in range(0, len(points), chunk_size)]
+    hardware_params = HardwareConfig.from_params(hardware_params)
+
+    if max_workers == 1:
+        results = [_simulate_chunk(chunk, hardware_params, backend, bell_state, precision, max_shots) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_simulate_chunk, chunk, hardware_params, backend, bell_state, precision, max_shots) for chunk in chunks]
+            results = [future.result() for future in futures]
+
+    fidelities = {wl: {L: [None] * len(ram_photons_per_det_window[wl][L]) for L in fiber_lengths} for wl in wavelengths}
+    ns_fidelities = {wl: {L: [None] * len(ram_photons_per_det_window[wl][L]) for L in fiber_lengths} for wl in wavelengths}
+
+    for chunk_result in results:
+        for i, j, k, fidelity, ns_fidelity in chunk_result:
+            fidelities[wavelengths[i]][fiber_lengths[j]][k] = float(fidelity)
+            ns_fidelities[wavelengths[i]][fiber_lengths[j]][k] = ns_fidelity
+
+    return fidelities, ns_fidelities
+
+
+def plot_fidelities(launch_powers_mW, ns_fidelities, wavelengths, fiber_lengths, path=None, show=False, title=r"Coexisting Fidelity"):
+    import matplotlib
+    if not show:
+        matplotlib.use("Agg")  # off-screen, no display needed
+    import matplotlib.pyplot as plt
+
+    colors = ['blue', 'orange', 'green', 'red', 'purple']
+    linestyles = ['solid', 'dashed', 'dotted', 'dashdot']
+
+    fig, ax = plt.subplots()
+    for i, wl in enumerate(wavelengths):
+        for j, l in enumerate(fiber_lengths):
+            # one colour per wavelength, one line style per link length
+            ax.plot(launch_powers_mW, ns_fidelities[wl][l], label=f"{wl} ({l} km)", color=colors[i % len(colors)], linestyle=linestyles[j % len(linestyles)])
+
+    ax.axhline(y=0.25, linestyle="dotted", color="black")
+    ax.set_ylim(0.2, 1)
+    ax.set_xlabel(r"Launch Power [mW]")
+    ax.set_ylabel(r"$F'$")
+    ax.set_title(title)
+    ax.legend(title="Wavelength [nm]")
+    ax.grid(True)
+
+    if path is not None:
+        fig.savefig(path)
+    if show:
+        plt.show()
+    plt.close(fig)
+
+
+def write_results(path, launch_powers_mW, fidelities, ns_fidelities, wavelengths, fiber_lengths):
+    # one row per sweep point; .json gets the nested layout, anything else CSV
+    if path.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump({
+                'launch_powers_mW': list(map(float, launch_powers_mW)),
+                'fidelities': {str(wl): {str(l): list(map(float, fidelities[wl][l])) for l in fiber_lengths} for wl in wavelengths},
+                'ns_fidelities': {str(wl): {str(l): list(map(float, ns_fidelities[wl][l])) for l in fiber_lengths} for wl in wavelengths},
+            }, f, indent=2)
+        return
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['wavelength', 'fiber_length', 'launch_power_mW', 'fidelity', 'ns_fidelity'])
+        for wl in wavelengths:
+            for l in fiber_lengths:
+                for p, fidelity, ns_fidelity in zip(launch_powers_mW, fidelities[wl][l], ns_fidelities[wl][l]):
+                    writer.writerow([wl, l, float(p), float(fidelity), float(ns_fidelity)])
+
+
+def _positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+def main(argv=None):
+    from hardware_config import load_config
+
+    parser = argparse.ArgumentParser(description="Coexisting Raman noise fidelity sweep")
+    parser.add_argument('--config', help="TOML or YAML sweep definition (see example_sweep.toml)")
+    parser.add_argument('--backend', choices=BACKENDS, help="overrides run.backend")
+    parser.add_argument('--workers', type=_positive_int, help="overrides run.workers; more than 1 runs the sweep in a process pool, with identical results")
+    parser.add_argument('--output', help="overrides run.output; results file, .csv or .json")
+    parser.add_argument('--plot', help="overrides run.plot; render the fidelity plot to this .png/.svg file")
+    parser.add_argument('--precision', type=float, help="overrides run.precision; Monte Carlo interval half-width")
+    parser.add_argument('--max-shots', type=_positive_int, help="overrides run.max_shots; Monte Carlo shots per sweep point")
+    parser.add_argument('--show', action='store_true', help="open the plot in an interactive window")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log per-point visibility diagnostics")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    config = load_config(args.config)
+    run = config['run']
+    for key in ('backend', 'workers', 'output', 'plot', 'precision', 'max_shots'):
+        if getattr(args, key) is not None:
+            run[key] = getattr(args, key)
+
+    if not isinstance(run['workers'], int) or run['workers'] < 1:
+        parser.error(f"run.workers must be a positive integer, got {run['workers']!r}")
+    # a sweep whose results go nowhere is not worth running
+    if not (run.get('output') or run.get('plot') or args.show):
+        parser.error("nothing to do: set run.output or run.plot, or pass --output, --plot or --show")
+
     # Load data
-    data = read_measurement_data('RAMAN_Charact.xlsx', 'Meas_1565_HP_DP')
-    
+    data = load_measurement_data(config['data']['workbook'], config['data']['sheet'])
+
     # Use max input power to estimate rho
     max_power = np.max(data['P_TX'])
     rho = calculate_rho(
@@ -265,44 +926,26 @@ if __name__ == "__main__":
         RBW=RBW
     )
 
-    # Raman photon calculation
-     # CONFIGURABLE: select your lengths and wavelengths of choice
-    fiber_lengths = [5, 50]  # km
-    wavelengths = [1510, 1554, 1563.4, 1566.6, 1580]
+    sweep = config['sweep']
+    hardware_params = HardwareConfig(config['hardware'])
 
-    # CONFIGURABLE: Select which hardware parameters to use to calculate visibility --> fidelity based on your experiment type
-    from hardware_config import hardware_params  
+    wl_index = WavelengthIndex.from_data(data)
+    ram_photons_per_det_window = calc_raman_photon_grid(sweep['launch_powers_mW'], rho, sweep['wavelengths'], sweep['fiber_lengths'], hardware_params.detection_window, wl_index=wl_index)
 
+    logger.info("Sweeping %d points with the %s backend", ram_photons_per_det_window.photons.size, run['backend'])
+    # per-point seeds do not depend on the worker count; one worker runs in-process
+    fidelities, ns_fidelities = simulate_parallel(ram_photons_per_det_window, hardware_params, sweep['fiber_lengths'], sweep['wavelengths'], backend=run['backend'],
+                                                  max_workers=run['workers'], precision=run['precision'], max_shots=run['max_shots'])
 
-    launch_powers_mW = np.linspace(0, 10, 100)
-    ram_photons_per_det_window = calc_raman_photons(launch_powers_mW, rho, data['alpha_np'], wavelengths, fiber_lengths, hardware_params['detection_window'])
-    
-    # Fidelity simulation
-    # CONFIGURABLE: pass the correct hardware_params for your type of experiment
-    fidelities, ns_fidelities = simulate(ram_photons_per_det_window, hardware_params, fiber_lengths, wavelengths, data['alpha_np'], data['wavelengths'])
+    if run.get('output'):
+        write_results(run['output'], sweep['launch_powers_mW'], fidelities, ns_fidelities, sweep['wavelengths'], sweep['fiber_lengths'])
+        logger.info("Results written to %s", run['output'])
 
-    colors = ['blue', 'orange', 'green', 'red', 'purple']
-    wavelength_labels = ['1510 nm', '1554 nm', '1563.4 nm', '1566.6 nm', '1580 nm']
+    if run.get('plot') or args.show:
+        plot_fidelities(sweep['launch_powers_mW'], ns_fidelities, sweep['wavelengths'], sweep['fiber_lengths'], path=run.get('plot'), show=args.show, title=run['title'])
 
-    #for i, wl in enumerate(wavelengths):
-    #    for l in fiber_lengths: 
-    #        plt.plot(launch_powers_mW, ns_fidelities[wl][l], label=wl, color=colors[i])
+    return 0
 
-    # CONFIGURABLE link length to graph
-    for i, wl in enumerate(wavelengths):
-        for l in fiber_lengths: 
-            if l == 5:
-                plt.plot(launch_powers_mW, ns_fidelities[wl][l], label=wl, color=colors[i])
-            if l == 50:
-                plt.plot(launch_powers_mW, ns_fidelities[wl][l], label=wl, color=colors[i], linestyle='dashed')
 
-    
-    plt.axhline(y=0.25, linestyle="dotted", color="black")  
-    plt.ylim(0.2, 1)
-    plt.xlabel(r"Launch Power [mW]")
-    plt.ylabel(r"$F'$")
-    plt.title(r"(a) Coexisting Fidelity for a 20 km Link")
-    #plt.title(r"(b) Coexisting Fidelity for 5 km MAN Link")
-    plt.legend(title="Wavelength [nm]")
-    plt.grid(True)
-    plt.show()
+if __name__ == "__main__":
+    raise SystemExit(main())
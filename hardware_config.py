@@ -2,15 +2,17 @@
 # & Kumar, P. (2024). Quantum teleportation coexisting with classical communications in optical fiber. 
 # Optica, 11(12), 1700-1707.
 
+import os
+
 hardware_params = {
   # setup assumes 2 single photon detectors: d0, d1
   # and two links, 0 and 1
   # 0 is the coexisting link, with fibre, receiver optics, and detector 0
   # 1 is the heralding arm, with receiver optics, detector 1, and no fibre
 
-  'raman_photons_per_det_window' : None, # [photons / det_window]
+  'raman_photons_per_det_window' : None, # [photons / det_window]. per-point, passed to calc_visibility() alongside HardwareConfig; only read when not passed
   'fibre_attenuation' : -0.2, # -0.2 dB / km
-  'coexisting_fibre_loss' : None, # dB. overwritten in characterized_coex_sim.simulate()
+  'coexisting_fibre_loss' : None, # dB. per-point, HardwareConfig.fibre_loss(length); only read when not passed to calc_visibility()
   'dark_counts_per_det_window' : 50 * 1e-9 , # 50 * 1e-9
   'mean_noise_photons_per_interval_d1' : 0, # no noise beyond source noise at heralding arm
   'detection_eff_d0' : -6, # -6 detector 0 detection efficiency [dB],
@@ -21,3 +23,142 @@ hardware_params = {
   'receiver_transmittance_d1' : 0, # transmittance of optical elements at receiver 1 [dB]
   'detection_window': 5e-10  # 5e-10 500 ps
 }
+
+
+class HardwareConfig:
+  # Frozen view of the static entries of hardware_params with the dB -> linear
+  # conversions done once. The per-point quantities (raman_photons_per_det_window
+  # and coexisting_fibre_loss) are not stored here and are passed separately.
+  PARAMS = ('fibre_attenuation', 'dark_counts_per_det_window', 'mean_noise_photons_per_interval_d1',
+            'detection_eff_d0', 'detection_eff_d1', 'mean_photons_per_pulse', 'mean_noise_photons_per_pulse',
+            'receiver_transmittance_d0', 'receiver_transmittance_d1', 'detection_window')
+
+  __slots__ = PARAMS + ('n_d0', 'n_d1', 'nr_0', 'nr_1', 'total_transmittance_n1')
+
+  def __init__(self, params):
+    for key in self.PARAMS:
+      object.__setattr__(self, key, params[key])
+
+    object.__setattr__(self, 'n_d0', 10**(self.detection_eff_d0 / 10)) # detector 0 detection efficiency [%]
+    object.__setattr__(self, 'n_d1', 10**(self.detection_eff_d1 / 10)) # detector 1 detection efficiency [%]
+    object.__setattr__(self, 'nr_0', 10**(self.receiver_transmittance_d0 / 10)) # transmittance of optical elements at receiver 0 [%]
+    object.__setattr__(self, 'nr_1', 10**(self.receiver_transmittance_d1 / 10)) # transmittance of optical elements at receiver 1 [%]
+    object.__setattr__(self, 'total_transmittance_n1', self.nr_1 * self.n_d1) # total transmittance from Bob --> d1 [%]
+
+  @classmethod
+  def from_params(cls, params):
+    return params if isinstance(params, cls) else cls(params)
+
+  def __setattr__(self, key, value):
+    raise AttributeError(f"{type(self).__name__} is frozen")
+
+  def __delattr__(self, key):
+    raise AttributeError(f"{type(self).__name__} is frozen")
+
+  def __reduce__(self):
+    return (type(self), (self.as_dict(),))
+
+  def __eq__(self, other):
+    return isinstance(other, HardwareConfig) and self.as_tuple() == other.as_tuple()
+
+  def __hash__(self):
+    return hash(self.as_tuple())
+
+  def __repr__(self):
+    return f"{type(self).__name__}({self.as_dict()!r})"
+
+  def as_tuple(self):
+    return tuple(getattr(self, key) for key in self.PARAMS)
+
+  def as_dict(self):
+    return {key: getattr(self, key) for key in self.PARAMS}
+
+  def fibre_loss(self, length_km):
+    return self.fibre_attenuation * length_km # dB
+
+
+# Sweep run by characterized_coex_sim.main() when no config file is given.
+# A TOML or YAML config file has the same sections and keys; whatever it sets
+# replaces these defaults, and its [hardware] entries override hardware_params.
+DEFAULT_CONFIG = {
+  'data': {
+    'workbook': 'RAMAN_Charact.xlsx',
+    'sheet': 'Meas_1565_HP_DP',
+  },
+  'sweep': {
+    'wavelengths': [1510, 1554, 1563.4, 1566.6, 1580], # nm
+    'fiber_lengths': [5, 50], # km
+    'launch_powers_mW': {'start': 0, 'stop': 10, 'num': 100}, # list, or linspace arguments
+  },
+  'run': {
+    'backend': 'netsquid', # 'netsquid', 'analytic' or 'montecarlo'
+    'workers': 1,
+    'output': 'fidelities.csv', # .csv or .json results file
+    'plot': None, # .png or .svg fidelity plot
+    'precision': 1e-3, # montecarlo: target half-width of the fidelity interval
+    'max_shots': 1_000_000, # montecarlo: shot budget per sweep point
+    'title': "Coexisting Fidelity", # plot title
+  },
+  'hardware': {},
+}
+
+
+def _read_config_file(path):
+  if path.endswith(('.yaml', '.yml')):
+    try:
+      import yaml
+    except ImportError:
+      raise ImportError("YAML configs need PyYAML (pip install pyyaml); TOML configs work without it")
+    with open(path) as f:
+      return yaml.safe_load(f) or {}
+
+  try:
+    import tomllib
+  except ImportError:  # Python < 3.11
+    import tomli as tomllib
+  with open(path, 'rb') as f:
+    return tomllib.load(f)
+
+
+# file paths in a config; relative ones are taken relative to the config file
+PATH_KEYS = {'data': ('workbook',), 'run': ('output', 'plot')}
+
+LINSPACE_KEYS = ('start', 'stop', 'num')
+
+
+def load_config(path=None):
+  config = {section: dict(values) for section, values in DEFAULT_CONFIG.items()}
+
+  if path is not None:
+    config_dir = os.path.dirname(os.path.abspath(path))
+
+    for section, values in _read_config_file(path).items():
+      if section not in config:
+        raise ValueError(f"unknown config section {section!r} in {path}. Must be one of: {sorted(config)}")
+
+      # [hardware] is checked against hardware_params below
+      if section != 'hardware':
+        unknown = set(values) - set(DEFAULT_CONFIG[section])
+        if unknown:
+          raise ValueError(f"unknown keys {sorted(unknown)} in [{section}] of {path}. Must be among: {sorted(DEFAULT_CONFIG[section])}")
+
+      values = dict(values)
+      for key in PATH_KEYS.get(section, ()):
+        if values.get(key) is not None:
+          values[key] = os.path.join(config_dir, os.path.expanduser(values[key]))
+
+      config[section].update(values)
+
+  unknown = set(config['hardware']) - set(hardware_params)
+  if unknown:
+    raise ValueError(f"unknown hardware parameters: {sorted(unknown)}")
+  config['hardware'] = dict(hardware_params, **config['hardware'])
+
+  powers = config['sweep']['launch_powers_mW']
+  if isinstance(powers, dict):
+    if set(powers) != set(LINSPACE_KEYS):
+      raise ValueError(f"sweep.launch_powers_mW needs exactly the keys {list(LINSPACE_KEYS)}, got {sorted(powers)}")
+    import numpy as np
+    config['sweep']['launch_powers_mW'] = np.linspace(powers['start'], powers['stop'], powers['num'])
+
+  return config
@@ -17,22 +17,41 @@ from netsquid.nodes import Node
 from netsquid.nodes import Network
 from netsquid.components import QuantumMemory
 from netsquid.qubits.dmtools import DenseDMRepr
+import numpy as np
+from collections import namedtuple
+from statistics import NormalDist
+
+import analytic_entanglement as analytic
+from instrumentation import stage
+from analytic_entanglement import get_dep_prob_from_v
 
 
 FIBRE_LENGTH = 1
 C = .0002 # speed of light in NetSquid fiber [km/ns]
+CHANNEL_DELAY = FIBRE_LENGTH / C # time a qubit spends in the QuantumChannel [ns]
 DELAY = (FIBRE_LENGTH / C) + 1
 
 class EmitProtocol(NodeProtocol):
-    def __init__(self, node, verbose=False):
+    def __init__(self, node, verbose=False, num_pairs=1, period=DELAY, depolar_probs=None, noise_model=None):
       # init parent NodeProtocol
       super().__init__(node)
 
       self.meas_results = []
 
+      # a single run may emit several pairs on a clock; when depolar_probs is
+      # given, noise_model.depolar_rate is set to depolar_probs[n] before pair n
+      self.num_pairs = num_pairs
+      self.period = period
+      self.depolar_probs = depolar_probs
+      self.noise_model = noise_model
+
     def run(self):
-        self.node.subcomponents['qsource'].trigger()
-        yield self.await_timer(DELAY)
+        for n in range(self.num_pairs):
+            if self.depolar_probs is not None:
+                self.noise_model.depolar_rate = self.depolar_probs[n]
+
+            self.node.subcomponents['qsource'].trigger()
+            yield self.await_timer(self.period)
 
 
 class ReceiveProtocol(NodeProtocol):
@@ -83,21 +102,28 @@ class QuantumConnection(Connection):
                               forward_input=[("A", "send")],
                               forward_output=[("B", "recv")])
 
-def characterized_network_setup(bell_state, depolar_prob):
+def characterized_network_setup(bell_state, depolar_prob, qformalism=ns.QFormalism.DM):
 
     pure_input_1, pure_input_2 = ns.qubits.create_qubits(2, no_state=True)
     if bell_state == 'phi+':
-        ns.qubits.qubitapi.assign_qstate([pure_input_1, pure_input_2], ks.b00)
+        bell_ket = ks.b00
     elif bell_state == 'phi-':
-        ns.qubits.qubitapi.assign_qstate([pure_input_1, pure_input_2], ks.b10)
+        bell_ket = ks.b10
     elif bell_state == 'psi+':
-        ns.qubits.qubitapi.assign_qstate([pure_input_1, pure_input_2], ks.b01)
+        bell_ket = ks.b01
     elif bell_state == 'psi-':
-        ns.qubits.qubitapi.assign_qstate([pure_input_1, pure_input_2], ks.b11)
+        bell_ket = ks.b11
     else:
         print("ERROR: unknown Bell State input. Must be: 'phi+', 'phi-', 'psi+', 'psi-'")
         exit(1)
-    pure_input_state = DenseDMRepr(ns.qubits.reduced_dm([pure_input_1, pure_input_2]))
+    ns.qubits.qubitapi.assign_qstate([pure_input_1, pure_input_2], bell_ket)
+
+    # the source emits a DM in DM formalism and the pure ket otherwise, so
+    # ket/stabilizer runs never hold a density matrix
+    if qformalism == ns.QFormalism.DM:
+        pure_input_state = DenseDMRepr(ns.qubits.reduced_dm([pure_input_1, pure_input_2]))
+    else:
+        pure_input_state = bell_ket
 
 
     emitter = Node("Emitter", qmemory=QuantumMemory("EmitterQmem", num_positions=1))
@@ -138,47 +164,134 @@ def setup_datacollectors(prot_emitter, prot_rx):
 
     return dc_fidelity
 
-def get_dep_prob_from_v(noisy_visibility):
-  depolarized_fidelity = (1 + 3 * noisy_visibility) / 4
-  depolar_prob = 1 - depolarized_fidelity
 
-  return (4/3) * depolar_prob
+class ResultSlot(pydynaa.Entity):
+    # Lightweight replacement for the DataCollector above: the Bell pair and
+    # its reduced DM are written into preallocated attributes when the
+    # receiver signals SUCCESS, so no pandas DataFrame is built per run.
+    def __init__(self, prot_emitter, prot_rx):
+        super().__init__()
+        self.prot_emitter = prot_emitter
+        self.prot_rx = prot_rx
+
+        self.b1 = None
+        self.b2 = None
+        self.dm = np.zeros((4, 4), dtype=complex)
+        self.filled = False
+
+        self._handler = pydynaa.EventHandler(self._collect)
+        self._wait(self._handler, entity=prot_rx, event_type=Signals.SUCCESS.value)
+
+    def _collect(self, event):
+        self.b1, = self.prot_emitter.node.qmemory.pop(0)
+        self.b2 = self.prot_rx.bp
+        self.dm[...] = ns.qubits.reduced_dm([self.b1, self.b2])
+        self.filled = True
+
+        self._dismiss(self._handler, entity=self.prot_rx, event_type=Signals.SUCCESS.value)
+
+
+class ResultBuffer(pydynaa.Entity):
+    # ResultSlot for runs emitting several pairs: the reduced DM of pair n is
+    # written into dms[n] as it arrives at the receiver. The buffer stops
+    # listening once full, so buffers of earlier runs on the same protocols
+    # never collect again.
+    def __init__(self, prot_emitter, prot_rx, capacity):
+        super().__init__()
+        self.prot_emitter = prot_emitter
+        self.prot_rx = prot_rx
+
+        self.dms = np.zeros((capacity, 4, 4), dtype=complex)
+        self.count = 0
+
+        self._handler = pydynaa.EventHandler(self._collect)
+        self._wait(self._handler, entity=prot_rx, event_type=Signals.SUCCESS.value)
+
+    def _collect(self, event):
+        b1, = self.prot_emitter.node.qmemory.pop(0)
+        self.dms[self.count] = ns.qubits.reduced_dm([b1, self.prot_rx.bp])
+        self.count += 1
+
+        if self.count == len(self.dms):
+            self._dismiss(self._handler, entity=self.prot_rx, event_type=Signals.SUCCESS.value)
+
+
+# pure reference DM per Bell state, computed on first use
+_reference_dms = {}
 
+def reference_dm(bell_state, pure_input_1, pure_input_2):
+    if bell_state not in _reference_dms:
+        _reference_dms[bell_state] = ns.qubits.reduced_dm([pure_input_1, pure_input_2])
 
-def run_coex_ent_experiment(noisy_visibility, random_seed = 1, bell_state="phi+", verbose=True):
+    return _reference_dms[bell_state]
 
-    ns.set_qstate_formalism(ns.QFormalism.DM)
-    ns.set_random_state(seed=random_seed)
-    ns.sim_reset()
+BACKENDS = ("netsquid", "analytic", "montecarlo")
+COLLECTIONS = ("slot", "dataframe")
+
+def run_coex_ent_experiment(noisy_visibility, random_seed = 1, bell_state="phi+", verbose=True, backend="netsquid", collection="slot",
+                            session=None, precision=1e-3, max_shots=1_000_000):
+    # session, precision and max_shots only apply to the montecarlo backend;
+    # a sweep passes the same session_for_backend("montecarlo") to every point
+
+    if backend == "analytic":
+        # no qubits exist on this path, only the resulting fidelity
+        f_ent, depolar_prob = analytic.run_coex_ent_analytic(noisy_visibility, bell_state=bell_state)
+        return float(f_ent), None, None, float(depolar_prob)
+    elif backend == "montecarlo":
+        estimate = run_coex_ent_monte_carlo(noisy_visibility, bell_state=bell_state, random_seed=random_seed, precision=precision, max_shots=max_shots, session=session)
+        return estimate.mean, None, None, get_dep_prob_from_v(noisy_visibility=noisy_visibility)
+    elif backend != "netsquid":
+        raise ValueError(f"unknown backend {backend!r}. Must be one of: {BACKENDS}")
+    if collection not in COLLECTIONS:
+        raise ValueError(f"unknown collection {collection!r}. Must be one of: {COLLECTIONS}")
+
+    with stage("run_coex_ent_experiment.reset"):
+        ns.set_qstate_formalism(ns.QFormalism.DM)
+        ns.set_random_state(seed=random_seed)
+        ns.sim_reset()
 
     # calculate mixing probability from visibility
     depolar_prob = get_dep_prob_from_v(noisy_visibility=noisy_visibility)
 
     # setup network and simulation
-    network, pure_input_1, pure_input_2 = characterized_network_setup(bell_state=bell_state, depolar_prob = depolar_prob)
+    with stage("run_coex_ent_experiment.network_setup"):
+        network, pure_input_1, pure_input_2 = characterized_network_setup(bell_state=bell_state, depolar_prob = depolar_prob)
 
-    node_e = network.get_node("Emitter")
-    node_r = network.get_node("Receiver")
+        node_e = network.get_node("Emitter")
+        node_r = network.get_node("Receiver")
 
-    emit_prot = EmitProtocol(node_e)
-    recv_prot = ReceiveProtocol(node_r, verbose=verbose)
+        emit_prot = EmitProtocol(node_e)
+        recv_prot = ReceiveProtocol(node_r, verbose=verbose)
 
-    coex_fiber_dm = setup_datacollectors(emit_prot, recv_prot)
+        if collection == "slot":
+            slot = ResultSlot(emit_prot, recv_prot)
+        else:
+            coex_fiber_dm = setup_datacollectors(emit_prot, recv_prot)
 
-    emit_prot.start()
-    recv_prot.start()
+    with stage("run_coex_ent_experiment.protocol_start"):
+        emit_prot.start()
+        recv_prot.start()
 
     # run sim
-    ns.sim_run()
+    with stage("run_coex_ent_experiment.sim_run"):
+        ns.sim_run()
 
     # save data
-    coex_fiber_dm = coex_fiber_dm.dataframe
+    with stage("run_coex_ent_experiment.collect"):
+        if collection == "slot":
+            if not slot.filled:
+                raise RuntimeError("Receiver did not get the Bell pair half during the run")
+            noisy_output_1, noisy_output_2, noisy_dm = slot.b1, slot.b2, slot.dm
+        else:
+            coex_fiber_dm = coex_fiber_dm.dataframe
 
-    # calculate fidelity
-    noisy_output_1 = coex_fiber_dm.iloc[0]['b1']
-    noisy_output_2 = coex_fiber_dm.iloc[0]['b2']
+            noisy_output_1 = coex_fiber_dm.iloc[0]['b1']
+            noisy_output_2 = coex_fiber_dm.iloc[0]['b2']
+            noisy_dm = coex_fiber_dm.iloc[0]['dm']
 
-    f_ent = ns.qubits.dmutil.dm_fidelity(ns.qubits.reduced_dm([noisy_output_1, noisy_output_2]), ns.qubits.reduced_dm([pure_input_1, pure_input_2]), squared=True, dm_check=True)
+    # calculate fidelity, reusing the DM computed when the result was collected
+    with stage("run_coex_ent_experiment.dm_fidelity"):
+        f_ent = ns.qubits.dmutil.dm_fidelity(noisy_dm, reference_dm(bell_state, pure_input_1, pure_input_2), squared=True, dm_check=True)
 
 
     if verbose:
@@ -186,3 +299,183 @@ def run_coex_ent_experiment(noisy_visibility, random_seed = 1, bell_state="phi+"
         print("depolar_prob:", depolar_prob)
 
     return f_ent, noisy_output_1, noisy_output_2, depolar_prob
+
+
+
+class CoexEntSession:
+    # Emitter/receiver network built once per Bell state and reused across
+    # sweep points. Only the depolar_rate of the channel's DepolarNoiseModel
+    # changes between runs; the simulator timeline and the protocols are reset.
+    def __init__(self, bell_state="phi+", verbose=False, qformalism=ns.QFormalism.DM):
+        ns.set_qstate_formalism(qformalism)
+
+        self.bell_state = bell_state
+        self.verbose = verbose
+        self.qformalism = qformalism
+
+        self.network, self.pure_input_1, self.pure_input_2 = characterized_network_setup(bell_state=bell_state, depolar_prob=0, qformalism=qformalism)
+
+        self.node_e = self.network.get_node("Emitter")
+        self.node_r = self.network.get_node("Receiver")
+
+        q_conn = self.network.get_connection(self.node_e, self.node_r, label="quantum")
+        self.noise_model = q_conn.subcomponents["qChannel_A2B"].models["quantum_noise_model"]
+
+        self.emit_prot = EmitProtocol(self.node_e, noise_model=self.noise_model)
+        self.recv_prot = ReceiveProtocol(self.node_r, verbose=verbose)
+
+        self.pure_input_dm = reference_dm(bell_state, self.pure_input_1, self.pure_input_2)
+
+    def set_depolar_prob(self, depolar_prob):
+        self.noise_model.depolar_rate = depolar_prob
+
+    def run(self, noisy_visibility, random_seed=1):
+        with stage("CoexEntSession.reset"):
+            ns.set_qstate_formalism(self.qformalism)
+            ns.set_random_state(seed=random_seed)
+            ns.sim_reset()
+
+            depolar_prob = get_dep_prob_from_v(noisy_visibility=noisy_visibility)
+            self.set_depolar_prob(depolar_prob)
+
+        # stop + start, any leftover waits from the previous run are dropped
+        with stage("CoexEntSession.protocol_start"):
+            self.recv_prot.bp = None
+            self.emit_prot.num_pairs = 1
+            self.emit_prot.depolar_probs = None
+            self.emit_prot.period = DELAY
+            self.emit_prot.reset()
+            self.recv_prot.reset()
+
+        with stage("CoexEntSession.sim_run"):
+            ns.sim_run()
+
+        with stage("CoexEntSession.collect"):
+            noisy_output_1, = self.node_e.qmemory.pop(0)
+            noisy_output_2 = self.recv_prot.bp
+            if noisy_output_2 is None:
+                raise RuntimeError("Receiver did not get the Bell pair half during the run")
+
+        with stage("CoexEntSession.dm_fidelity"):
+            f_ent = ns.qubits.dmutil.dm_fidelity(ns.qubits.reduced_dm([noisy_output_1, noisy_output_2]), self.pure_input_dm, squared=True, dm_check=True)
+
+        if self.verbose:
+            print("final f_ent:", f_ent)
+            print("depolar_prob:", depolar_prob)
+
+        return f_ent, noisy_output_1, noisy_output_2, depolar_prob
+
+    def run_pairs(self, noisy_visibilities, random_seed=1, period=DELAY):
+        # Emits one pair per entry of noisy_visibilities in a single simulation,
+        # changing the depolarization between emissions. Returns the fidelity,
+        # depolarizing probability and reduced DM of every pair.
+        #
+        # The emitter memory holds one half at a time, so a pair must have
+        # reached the receiver before the next one is emitted.
+        if period <= CHANNEL_DELAY:
+            raise ValueError(f"period {period} ns must exceed the channel delay of {CHANNEL_DELAY} ns")
+
+        depolar_probs = get_dep_prob_from_v(noisy_visibility=np.asarray(noisy_visibilities, dtype=float).ravel())
+
+        with stage("CoexEntSession.reset"):
+            ns.set_qstate_formalism(self.qformalism)
+            ns.set_random_state(seed=random_seed)
+            ns.sim_reset()
+
+        with stage("CoexEntSession.protocol_start"):
+            self.recv_prot.bp = None
+            self.emit_prot.num_pairs = len(depolar_probs)
+            self.emit_prot.depolar_probs = depolar_probs
+            self.emit_prot.period = period
+
+            buffer = ResultBuffer(self.emit_prot, self.recv_prot, capacity=len(depolar_probs))
+
+            self.emit_prot.reset()
+            self.recv_prot.reset()
+
+        with stage("CoexEntSession.sim_run"):
+            ns.sim_run()
+
+        if buffer.count != len(depolar_probs):
+            raise RuntimeError(f"Receiver got {buffer.count} of {len(depolar_probs)} Bell pair halves during the run")
+
+        with stage("CoexEntSession.dm_fidelity"):
+            f_ent = np.array([ns.qubits.dmutil.dm_fidelity(dm, self.pure_input_dm, squared=True, dm_check=True) for dm in buffer.dms])
+
+        return f_ent, depolar_probs, buffer.dms
+
+
+# Network session a sweep reuses for every point of a NetSquid backend: DM for
+# the exact netsquid backend, ket for montecarlo sampling
+SESSION_FORMALISMS = {"netsquid": ns.QFormalism.DM, "montecarlo": ns.QFormalism.KET}
+
+def session_for_backend(backend, bell_state="phi+"):
+    if backend not in SESSION_FORMALISMS:
+        raise ValueError(f"backend {backend!r} has no network session. Must be one of: {tuple(SESSION_FORMALISMS)}")
+
+    return CoexEntSession(bell_state=bell_state, qformalism=SESSION_FORMALISMS[backend])
+
+
+def cross_check_backends(noisy_visibilities, bell_state="phi+", n_samples=10, random_seed=1, atol=1e-9):
+    # run a sample of points through both backends and assert they agree
+    noisy_visibilities = np.ravel(np.asarray(noisy_visibilities, dtype=float))
+    rng = np.random.default_rng(random_seed)
+    sample = rng.choice(noisy_visibilities.size, size=min(n_samples, noisy_visibilities.size), replace=False)
+
+    analytic_f, _ = analytic.run_coex_ent_analytic(noisy_visibilities[sample], bell_state=bell_state)
+
+    for v, f_analytic in zip(noisy_visibilities[sample], analytic_f):
+        f_ns, _, _, _ = run_coex_ent_experiment(v, random_seed=random_seed, bell_state=bell_state, verbose=False)
+        if not np.isclose(f_ns, f_analytic, rtol=0, atol=atol):
+            raise AssertionError(f"analytic backend disagrees with NetSquid at visibility {v}: {f_analytic} != {f_ns}")
+
+    return sample
+
+
+MonteCarloEstimate = namedtuple('MonteCarloEstimate', ['mean', 'std_error', 'ci_low', 'ci_high', 'shots', 'converged'])
+
+# Wilson score interval for the mean of shots bounded in [0, 1]. Unlike the
+# normal approximation it keeps a finite width when every shot so far agrees,
+# e.g. no depolarized pair yet at V close to 1.
+def _wilson_interval(mean, shots, z):
+    mean = min(max(mean, 0.0), 1.0)
+    denom = 1 + z**2 / shots
+    centre = (mean + z**2 / (2 * shots)) / denom
+    half_width = z * np.sqrt(mean * (1 - mean) / shots + z**2 / (4 * shots**2)) / denom
+    return centre - half_width, centre + half_width
+
+def run_coex_ent_monte_carlo(noisy_visibility, bell_state="phi+", precision=1e-3, confidence=0.95, batch_shots=1000, max_shots=1_000_000,
+                             random_seed=1, qformalism=ns.QFormalism.KET, session=None):
+    # Stochastic estimate of the fidelity: in ket/stabilizer formalism the
+    # depolarizing channel is sampled per pair, so batches of shots are run
+    # (each batch one simulation with its own SeedSequence-derived seed) until
+    # the Wilson interval half-width drops below precision.
+    if session is None:
+        session = CoexEntSession(bell_state=bell_state, qformalism=qformalism)
+
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    max_batches = max(1, -(-max_shots // batch_shots))
+    batch_seeds = np.random.SeedSequence(random_seed).generate_state(max_batches)
+
+    shots = 0
+    total = 0.0
+    total_sq = 0.0
+
+    for seed in batch_seeds:
+        # the last batch is trimmed so that max_shots is a hard cap
+        n_shots = min(batch_shots, max_shots - shots)
+        f_ent, _, _ = session.run_pairs(np.full(n_shots, noisy_visibility, dtype=float), random_seed=int(seed))
+
+        shots += f_ent.size
+        total += f_ent.sum()
+        total_sq += np.square(f_ent).sum()
+
+        mean = total / shots
+        variance = max(total_sq / shots - mean**2, 0.0) * shots / max(shots - 1, 1)
+        std_error = np.sqrt(variance / shots)
+        ci_low, ci_high = _wilson_interval(mean, shots, z)
+
+        if (ci_high - ci_low) / 2 <= precision:
+            break
+
+    return MonteCarloEstimate(float(mean), float(std_error), float(ci_low), float(ci_high), shots, bool((ci_high - ci_low) / 2 <= precision))
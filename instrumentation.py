@@ -0,0 +1,134 @@
+import json
+import math
+import time
+from contextlib import contextmanager, nullcontext
+
+# Opt-in per-stage timing. Code marks its phases with
+#
+#   with instrumentation.stage("run_coex_ent_experiment.sim_run"):
+#       ns.sim_run()
+#
+# which is a shared no-op context manager unless a Profiler is active, e.g.
+#
+#   with instrumentation.profiling() as profiler:
+#       simulate(...)
+#   print(profiler.to_prometheus())
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, 10.0, math.inf)
+
+_NO_OP = nullcontext()
+_active = None
+
+
+class StageStats:
+    __slots__ = ('count', 'total', 'min', 'max', 'bucket_counts')
+
+    def __init__(self, n_buckets):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.bucket_counts = [0] * n_buckets
+
+    def to_dict(self, buckets):
+        return {
+            'count': self.count,
+            'total_s': self.total,
+            'mean_s': self.total / self.count if self.count else 0.0,
+            'min_s': self.min if self.count else 0.0,
+            'max_s': self.max,
+            'buckets': {('+Inf' if math.isinf(b) else repr(b)): n for b, n in zip(buckets, self.bucket_counts)},
+        }
+
+
+class Profiler:
+    def __init__(self, buckets=BUCKETS, callbacks=()):
+        self.buckets = tuple(buckets)
+        self.callbacks = list(callbacks)
+        self.stages = {}
+
+    def add_callback(self, callback):
+        # callback(stage, seconds) is invoked for every recorded phase
+        self.callbacks.append(callback)
+
+    def record(self, name, seconds):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats(len(self.buckets))
+
+        stats.count += 1
+        stats.total += seconds
+        stats.min = min(stats.min, seconds)
+        stats.max = max(stats.max, seconds)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                stats.bucket_counts[i] += 1
+                break
+
+        for callback in self.callbacks:
+            callback(name, seconds)
+
+    def reset(self):
+        self.stages.clear()
+
+    def to_dict(self):
+        return {name: stats.to_dict(self.buckets) for name, stats in self.stages.items()}
+
+    def to_json(self, path=None):
+        text = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def to_prometheus(self, metric="coex_stage_duration_seconds"):
+        # Prometheus text exposition format, one histogram labelled by stage
+        lines = [f"# HELP {metric} Wall time of instrumented simulation stages.", f"# TYPE {metric} histogram"]
+        for name, stats in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, stats.bucket_counts):
+                cumulative += n
+                le = '+Inf' if math.isinf(bound) else repr(bound)
+                lines.append(f'{metric}_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{stage="{name}"}} {stats.total!r}')
+            lines.append(f'{metric}_count{{stage="{name}"}} {stats.count}')
+        return "\n".join(lines) + "\n"
+
+
+class _StageTimer:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def stage(name):
+    if _active is None:
+        return _NO_OP
+    return _StageTimer(_active, name)
+
+
+def active_profiler():
+    return _active
+
+
+@contextmanager
+def profiling(profiler=None):
+    global _active
+
+    previous = _active
+    _active = profiler if profiler is not None else Profiler()
+    try:
+        yield _active
+    finally:
+        _active = previous
@@ -0,0 +1,125 @@
+import json
+import sqlite3
+from collections import OrderedDict
+
+from hardware_config import HardwareConfig
+
+# Cache of per-point sweep results (visibility, fidelity) so that repeated and
+# overlapping sweeps only pay for points that have not been evaluated before.
+# Keys are canonical tuples of the physical inputs with every float quantized
+# to a fixed number of significant digits, so values that differ only by
+# floating-point noise (e.g. from np.linspace) share an entry.
+
+SIGNIFICANT_DIGITS = 12
+
+
+def quantize(value, digits=SIGNIFICANT_DIGITS):
+    if value is None or isinstance(value, (str, bool)):
+        return value
+    if isinstance(value, (tuple, list)):
+        return tuple(quantize(v, digits) for v in value)
+
+    value = float(value)
+    return float(f"{value:.{digits}g}") + 0.0  # + 0.0 folds -0.0 into 0.0
+
+
+class SweepCache:
+    def __init__(self, max_entries=100_000, path=None, digits=SIGNIFICANT_DIGITS):
+        self.max_entries = max_entries
+        self.digits = digits
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lru = OrderedDict()
+
+        # optional on-disk backing store, shared between runs
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._lru)
+
+    def key(self, hardware_params, raman_photons_per_det_window, coexisting_fibre_loss, bell_state="phi+", random_seed=1, backend="netsquid", options=None):
+        # options: backend settings that change the result (e.g. the Monte Carlo
+        # precision); keys without options are unchanged from earlier runs
+        config = HardwareConfig.from_params(hardware_params)
+        key = [
+            quantize(config.as_tuple(), self.digits),
+            quantize(raman_photons_per_det_window, self.digits),
+            quantize(coexisting_fibre_loss, self.digits),
+            bell_state,
+            random_seed,
+            backend,
+        ]
+        if options is not None:
+            key.append(sorted(options.items()))
+
+        return json.dumps(key)
+
+    def get(self, key):
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return self._lru[key]
+
+        if self._db is not None:
+            row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                value = tuple(json.loads(row[0]))
+                self._remember(key, value)
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        value = tuple(float(v) for v in value)
+        self._remember(key, value)
+
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+
+        return value
+
+    def _remember(self, key, value):
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def flush(self):
+        if self._db is not None:
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._lru),
+        }
@@ -0,0 +1,246 @@
+import csv
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import analytic_entanglement as analytic
+import characterized_coex_sim as sim
+from hardware_config import HardwareConfig
+
+# Streaming version of characterized_coex_sim.simulate(). Raman-photon
+# generation, visibility and fidelity are generator stages that pass chunks
+# (dicts of equal-length arrays) along, so memory stays flat however large the
+# (wavelength x length x launch power) grid is. Every grid point has a flat id
+#   point = (i_wl * n_lengths + j_length) * n_powers + k_power
+# which the result store uses to skip points finished by an earlier run. The
+# store also records a fingerprint of the grid and settings, so ids are never
+# matched against results of a different sweep.
+
+COLUMNS = ('point', 'wavelength', 'fiber_length', 'launch_power_mW', 'raman_photons', 'visibility', 'fidelity', 'ns_fidelity')
+
+
+def raman_stage(P_launch, rho, wavelengths, fiber_lengths, detection_window, wl_index, chunk_size=10_000, skip_ranges=None):
+    # skip_ranges: sorted, disjoint [start, stop) ranges of finished point ids
+    # (CsvResultStore.completed()); only the ranges overlapping a chunk are used
+    P_launch = np.asarray(P_launch, dtype=float)
+    fiber_lengths = np.asarray(fiber_lengths, dtype=float)
+    wavelengths = np.asarray(wavelengths, dtype=float)
+
+    if not isinstance(wl_index, sim.WavelengthIndex):
+        wl_index = sim.WavelengthIndex(wl_index)
+    rho_wl = wl_index.interp(rho, wavelengths)
+
+    shape = (len(wavelengths), len(fiber_lengths), len(P_launch))
+    n_points = int(np.prod(shape))
+
+    skip_ranges = np.empty((0, 2), dtype=np.int64) if skip_ranges is None else np.asarray(skip_ranges, dtype=np.int64).reshape(-1, 2)
+
+    for start in range(0, n_points, chunk_size):
+        stop = min(start + chunk_size, n_points)
+        point = np.arange(start, stop)
+
+        # finished ranges that end after start and begin before stop
+        first = np.searchsorted(skip_ranges[:, 1], start, side='right')
+        last = np.searchsorted(skip_ranges[:, 0], stop, side='left')
+        if first < last:
+            keep = np.ones(point.size, dtype=bool)
+            for done_start, done_stop in skip_ranges[first:last]:
+                keep[max(done_start, start) - start:min(done_stop, stop) - start] = False
+            point = point[keep]
+            if point.size == 0:
+                continue
+
+        i, j, k = np.unravel_index(point, shape)
+        yield {
+            'point': point,
+            'grid_index': (i, j, k),
+            'wavelength': wavelengths[i],
+            'fiber_length': fiber_lengths[j],
+            'launch_power_mW': P_launch[k],
+            'raman_photons': sim.raman_photon_count(P_launch[k], fiber_lengths[j], wavelengths[i], rho_wl[i], detection_window),
+        }
+
+
+def visibility_stage(chunks, hardware_params):
+    config = HardwareConfig.from_params(hardware_params)
+
+    for chunk in chunks:
+        visibility = sim.calc_visibility_batch(chunk['raman_photons'], config.fibre_loss(chunk['fiber_length']), config)
+        chunk['visibility'] = visibility
+        chunk['fidelity'] = (1 + 3*visibility) / 4
+        yield chunk
+
+
+def fidelity_stage(chunks, backend="analytic", bell_state="phi+", base_seed=1, precision=1e-3, max_shots=1_000_000):
+    # same backends as import_coexisting_entanglement.run_coex_ent_experiment();
+    # NetSquid points are seeded like characterized_coex_sim.simulate_parallel()
+    if backend not in sim.BACKENDS:
+        raise ValueError(f"unknown backend {backend!r}. Must be one of: {sim.BACKENDS}")
+
+    session = None
+
+    for chunk in chunks:
+        if backend == "analytic":
+            chunk['ns_fidelity'], _ = analytic.run_coex_ent_analytic(chunk['visibility'], bell_state=bell_state)
+            yield chunk
+            continue
+
+        import import_coexisting_entanglement as ent
+        if session is None:
+            session = ent.session_for_backend(backend, bell_state=bell_state)
+
+        seeds = [sim.point_seed(i, j, k, base_seed) for i, j, k in zip(*chunk['grid_index'])]
+        if backend == "montecarlo":
+            chunk['ns_fidelity'] = np.array([ent.run_coex_ent_experiment(v, random_seed=seed, bell_state=bell_state, verbose=False, backend=backend,
+                                                                         session=session, precision=precision, max_shots=max_shots)[0]
+                                             for v, seed in zip(chunk['visibility'], seeds)])
+        else:
+            chunk['ns_fidelity'] = np.array([session.run(noisy_visibility=v, random_seed=seed)[0] for v, seed in zip(chunk['visibility'], seeds)])
+        yield chunk
+
+
+def grid_fingerprint(P_launch, rho_wl, wavelengths, fiber_lengths, hardware_params, backend="analytic", bell_state="phi+", base_seed=1, precision=1e-3, max_shots=1_000_000):
+    # sha1 of everything that decides the value stored for a point id; seeds
+    # and the Monte Carlo stopping rule only count for the backends using them
+    settings = {
+        'launch_powers_mW': np.asarray(P_launch, dtype=float).tolist(),
+        'rho': np.asarray(rho_wl, dtype=float).tolist(),
+        'wavelengths': np.asarray(wavelengths, dtype=float).tolist(),
+        'fiber_lengths': np.asarray(fiber_lengths, dtype=float).tolist(),
+        'hardware': list(HardwareConfig.from_params(hardware_params).as_tuple()),
+        'backend': backend,
+        'bell_state': bell_state,
+    }
+    if backend != "analytic":
+        settings['base_seed'] = base_seed
+    if backend == "montecarlo":
+        settings.update(precision=precision, max_shots=max_shots)
+
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+GRID_PREFIX = '# grid '
+
+class CsvResultStore:
+    # Append-only CSV of finished points. A row only counts once its line is
+    # complete, so a run killed mid-write resumes cleanly. The first line is a
+    # "# grid <fingerprint>" comment once a sweep has been bound to the store.
+    def __init__(self, path):
+        self.path = path
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._drop_partial_line()
+        else:
+            self._write_header(None)
+
+    def _write_header(self, fingerprint):
+        with open(self.path, 'w', newline='') as f:
+            if fingerprint is not None:
+                f.write(f"{GRID_PREFIX}{fingerprint}\n")
+            csv.writer(f).writerow(COLUMNS)
+
+    def fingerprint(self):
+        with open(self.path, newline='') as f:
+            first = f.readline()
+        return first[len(GRID_PREFIX):].strip() if first.startswith(GRID_PREFIX) else None
+
+    def bind(self, fingerprint):
+        # Ties the store to one sweep. An empty store takes the fingerprint; a
+        # store holding results of another (or an unrecorded) sweep raises.
+        stored = self.fingerprint()
+        if stored == fingerprint:
+            return
+
+        if stored is None and len(self.completed()) == 0:
+            self._write_header(fingerprint)
+            return
+
+        raise ValueError(f"{self.path} holds results of a different sweep (grid {stored}, this run {fingerprint}); use a new store path")
+
+    def _rows(self, f):
+        # data rows, after the grid comment and the column header
+        reader = csv.reader(line for line in f if not line.startswith('#'))
+        next(reader, None)
+        return (row for row in reader if row)
+
+    def _drop_partial_line(self):
+        with open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+
+            # walk back to the end of the last complete line
+            pos = size - 1
+            while pos > 0:
+                f.seek(pos - 1)
+                if f.read(1) == b'\n':
+                    break
+                pos -= 1
+            f.truncate(pos)
+
+    def completed(self):
+        # Finished point ids as sorted, disjoint [start, stop) ranges, read one
+        # row at a time. The pipeline appends points in increasing order, so a
+        # resumed run holds a range per gap instead of an entry per point.
+        ranges = []
+        with open(self.path, newline='') as f:
+            for row in self._rows(f):
+                point = int(row[0])
+                if ranges and ranges[-1][1] == point:
+                    ranges[-1][1] += 1
+                else:
+                    ranges.append([point, point + 1])
+
+        # rows written out of order (not by this pipeline) are merged here
+        ranges.sort()
+        merged = []
+        for start, stop in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+
+        return np.array(merged, dtype=np.int64).reshape(-1, 2)
+
+    def append(self, chunk):
+        with open(self.path, 'a', newline='') as f:
+            csv.writer(f).writerows(zip(*(np.asarray(chunk[column]).tolist() for column in COLUMNS)))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self):
+        with open(self.path, newline='') as f:
+            rows = list(self._rows(f))
+
+        columns = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+        result = {name: np.array(values, dtype=float) for name, values in zip(COLUMNS, columns)}
+        result['point'] = result['point'].astype(np.int64)
+        return result
+
+
+def run_sweep_pipeline(P_launch, rho, wavelengths, fiber_lengths, hardware_params, wl_index, store=None, backend="analytic", bell_state="phi+", chunk_size=10_000,
+                       base_seed=1, precision=1e-3, max_shots=1_000_000):
+    # Yields finished chunks; with a store every chunk is persisted before it is
+    # yielded and points already in the store are not recomputed.
+    config = HardwareConfig.from_params(hardware_params)
+
+    skip_ranges = None
+    if store is not None:
+        if not isinstance(wl_index, sim.WavelengthIndex):
+            wl_index = sim.WavelengthIndex(wl_index)
+        store.bind(grid_fingerprint(P_launch, wl_index.interp(rho, wavelengths), wavelengths, fiber_lengths, config, backend=backend, bell_state=bell_state,
+                                    base_seed=base_seed, precision=precision, max_shots=max_shots))
+        skip_ranges = store.completed()
+
+    chunks = raman_stage(P_launch, rho, wavelengths, fiber_lengths, config.detection_window, wl_index, chunk_size=chunk_size, skip_ranges=skip_ranges)
+    chunks = visibility_stage(chunks, config)
+    chunks = fidelity_stage(chunks, backend=backend, bell_state=bell_state, base_seed=base_seed, precision=precision, max_shots=max_shots)
+
+    for chunk in chunks:
+        if store is not None:
+            store.append(chunk)
+        yield chunk